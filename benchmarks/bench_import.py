@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Import time benchmark of the pycytools modules.
+
+Every import is timed in a fresh interpreter. For comparison the 'eager' rows
+additionally import the heavy dependencies, as pycytools did at module load
+before they were imported lazily.
+
+Usage:
+    python benchmarks/bench_import.py [--repeats 5]
+"""
+
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def is_installed(module):
+    try:
+        return importlib.util.find_spec(module) is not None
+    except ImportError:
+        return False
+
+
+# optional modules that are not installed are skipped
+HEAVY_MODULES = [m for m in ['pandas', 'scipy.ndimage', 'scipy.sparse', 'skimage.filters', 'skimage.measure',
+                             'skimage.morphology', 'skimage.transform', 'tifffile', 'requests', 'matplotlib.pyplot']
+                 if is_installed(m)]
+
+CASES = [
+    ('pycytools.library', 'import pycytools.library'),
+    ('pycytools.plots', 'import pycytools.plots'),
+    ('pycytools.transformations', 'import pycytools.transformations'),
+    ('pycytools.library (eager)', 'import pycytools.library; ' +
+     '; '.join('import ' + m for m in HEAVY_MODULES if m != 'matplotlib.pyplot')),
+    ('pycytools.plots (eager)', 'import pycytools.plots; ' + '; '.join('import ' + m for m in HEAVY_MODULES)),
+]
+
+TIMER = """
+import sys, time
+t = time.perf_counter()
+{stmt}
+t = time.perf_counter() - t
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(t, ','.join(heavy))
+"""
+
+
+def time_import(stmt, repeats):
+    """
+    :return: the median import time in seconds and the loaded heavy modules
+    """
+    env = dict(os.environ, PYTHONPATH=REPO + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    times = list()
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', TIMER.format(stmt=stmt, heavy=HEAVY_MODULES)],
+                             env=env, check=True, capture_output=True, text=True).stdout.split()
+        times.append(float(out[0]))
+        heavy = out[1] if len(out) > 1 else ''
+    return sorted(times)[len(times) // 2], heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    for name, stmt in CASES:
+        t, heavy = time_import(stmt, args.repeats)
+        print('{:<30} {:8.3f} s   loaded: {}'.format(name, t, heavy or '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the pycytools hot paths on synthetic data.
+
+Measures wall time (best of several repeats) and peak traced memory.
+
+Usage:
+    python benchmarks/run_benchmarks.py                  # run and print
+    python benchmarks/run_benchmarks.py --save out.json  # save the results
+    python benchmarks/run_benchmarks.py --compare benchmarks/baseline.json
+
+With --compare, results more than --tolerance times slower or larger than the
+baseline are reported as regressions and the exit code is 1.
+The baseline is machine dependent, regenerate it with --save on your machine.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from scipy.cluster import hierarchy
+from scipy.spatial import distance
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pycytools import library as lib  # noqa: E402
+from pycytools.external import optimal_leaf_ordering as olo  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import make_imc_stack, make_voronoi_labels  # noqa: E402
+
+PRESETS = {
+    'quick': {'images': [((256, 256), 300), ((512, 512), 1200)], 'n_channels': 10, 'leaves': [200, 500]},
+    'full': {'images': [((512, 512), 1200), ((1024, 1024), 5000), ((2048, 2048), 20000)], 'n_channels': 40,
+             'leaves': [500, 1000, 2000]},
+}
+
+
+def measure(fkt, repeats=3):
+    """
+    :param fkt: function without arguments
+    :return: dict with the best wall time in seconds and the peak traced memory in MB
+    """
+    times = list()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fkt()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fkt()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'time': min(times), 'peak_mb': peak / 2 ** 20}
+
+
+def image_cases(shape, n_cells, n_channels):
+    labels = make_voronoi_labels(shape, n_cells)
+    stack = make_imc_stack(labels, n_channels)
+    nb_dict = lib.create_neightbourhood_dict(labels)
+    ids = np.unique(labels[labels > 0])
+    cell_dat = pd.DataFrame(np.random.default_rng(0).random((len(ids), n_channels)),
+                            index=pd.MultiIndex.from_product([[0], ids], names=['cut_id', 'cell_id']),
+                            columns=pd.MultiIndex.from_product([['cell_int_mean'], range(n_channels)]))
+    nb_dicts = pd.Series({0: nb_dict})
+    nb_dicts.index.name = 'cut_id'
+    img_dat = cell_dat.xs(0, level='cut_id')['cell_int_mean']
+
+    return {
+        'apply_functions_to_labels[mean,median]':
+            lambda: lib.apply_functions_to_labels(labels, stack, ['mean', 'median']),
+        'find_touching_pixels[distance=1]': lambda: lib.find_touching_pixels(labels),
+        'find_touching_pixels[distance=3]': lambda: lib.find_touching_pixels(labels, distance=3),
+        'make_neighbourhood_graph[sparse]': lambda: lib.make_neighbourhood_graph(labels, output='sparse'),
+        'create_neightbourhood_dict': lambda: lib.create_neightbourhood_dict(labels),
+        'aggregate_nb_data_sparse[mean,max]':
+            lambda: lib.aggregate_nb_data_sparse(cell_dat, nb_dicts, stats=['mean', 'max']),
+        'aggregate_nb_data_imgs[default]': lambda: lib.aggregate_nb_data_imgs(cell_dat, nb_dicts),
+        'aggregate_nb_data[default]': lambda: lib.aggregate_nb_data(img_dat, nb_dict),
+    }
+
+
+def ordering_case(n_leaves):
+    X = np.random.default_rng(0).random((n_leaves, 10))
+    dists = distance.squareform(distance.pdist(X))
+    Z = hierarchy.linkage(X, 'average')
+    return lambda: olo.optimal_ordering(Z, dists)
+
+
+def run(preset, repeats):
+    config = PRESETS[preset]
+    results = dict()
+    for shape, n_cells in config['images']:
+        for name, fkt in image_cases(shape, n_cells, config['n_channels']).items():
+            key = '{} [{}x{}, {} cells, {} channels]'.format(name, shape[0], shape[1], n_cells,
+                                                             config['n_channels'])
+            results[key] = measure(fkt, repeats)
+            print('{:<90} {:9.4f} s {:9.1f} MB'.format(key, results[key]['time'], results[key]['peak_mb']))
+    for n_leaves in config['leaves']:
+        key = 'optimal_ordering [{} leaves]'.format(n_leaves)
+        results[key] = measure(ordering_case(n_leaves), repeats)
+        print('{:<90} {:9.4f} s {:9.1f} MB'.format(key, results[key]['time'], results[key]['peak_mb']))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of regression messages
+    """
+    regressions = list()
+    for key, res in results.items():
+        if key not in baseline:
+            continue
+        for metric in ('time', 'peak_mb'):
+            ratio = res[metric] / max(baseline[key][metric], 1e-9)
+            if ratio > tolerance:
+                regressions.append('{}: {} {:.4g} vs baseline {:.4g} ({:.2f}x)'.format(
+                    key, metric, res[metric], baseline[key][metric], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--save', help='save the results to this json file')
+    parser.add_argument('--compare', help='baseline json file to compare with')
+    parser.add_argument('--tolerance', type=float, default=2.0, help='allowed slowdown factor')
+    args = parser.parse_args()
+
+    results = run(args.preset, args.repeats)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({'preset': args.preset, 'results': results}, f, indent=1, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for msg in regressions:
+            print('REGRESSION ' + msg)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print('No regressions compared to ' + args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Generators for synthetic label masks and multichannel imc like image stacks
+"""
+
+import numpy as np
+from scipy import ndimage as ndi
+from scipy.spatial import cKDTree
+
+
+def make_voronoi_labels(shape=(1024, 1024), n_cells=2000, cell_radius=None, seed=0):
+    """
+    Creates a label mask of Voronoi cells around random seeds
+    :param shape: the image shape
+    :param n_cells: number of cells
+    :param cell_radius: maximal distance of a pixel to its seed, pixels further away
+        are background. Defaults to 0.6 * the mean seed spacing.
+    :param seed: random seed
+    :return: uint32 label mask, 0 is background
+    """
+    rng = np.random.default_rng(seed)
+    seeds = rng.random((n_cells, 2)) * np.array(shape)
+    if cell_radius is None:
+        cell_radius = 0.6 * np.sqrt(np.prod(shape) / n_cells)
+
+    rows, cols = np.indices(shape)
+    dist, idx = cKDTree(seeds).query(np.stack([rows.ravel(), cols.ravel()], axis=1))
+    labels = (idx + 1).astype(np.uint32)
+    labels[dist > cell_radius] = 0
+    labels = labels.reshape(shape)
+
+    # relabel consecutively, cells without pixels disappear
+    present = np.unique(labels[labels > 0])
+    lut = np.zeros(n_cells + 1, dtype=np.uint32)
+    lut[present] = np.arange(1, len(present) + 1)
+    return lut[labels]
+
+
+def make_imc_stack(labels, n_channels=40, hot_pixel_fraction=1e-4, seed=0):
+    """
+    Creates an imc like image stack: lognormal per cell expression,
+    blurred, poisson counts and some hot pixels
+    :param labels: a label mask, e.g. from make_voronoi_labels
+    :param n_channels: number of channels
+    :param hot_pixel_fraction: fraction of hot pixels per channel
+    :param seed: random seed
+    :return: float32 stack, XYC
+    """
+    rng = np.random.default_rng(seed)
+    n_labels = int(labels.max())
+    stack = np.empty(labels.shape + (n_channels,), dtype=np.float32)
+    for c in range(n_channels):
+        expr = np.zeros(n_labels + 1)
+        expr[1:] = rng.lognormal(mean=rng.uniform(0, 2), sigma=1, size=n_labels)
+        img = ndi.gaussian_filter(expr[labels], sigma=1)
+        img = rng.poisson(img + 0.1).astype(np.float32)
+        hot = rng.random(labels.shape) < hot_pixel_fraction
+        img[hot] += rng.uniform(100, 1000, hot.sum())
+        stack[..., c] = img
+    return stack
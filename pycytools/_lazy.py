@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy module imports, to keep the import of pycytools fast
+"""
+
+import importlib
+import sys
+
+
+class LazyModule(object):
+    """
+    Placeholder for a module, which is imported on the first attribute access
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self.__dict__['_module'] is None:
+            return '<lazy module ' + repr(self.__dict__['_name']) + ' (not loaded)>'
+        return repr(self.__dict__['_module'])
+
+
+def lazy_import(name):
+    """
+    :param name: the full module name, e.g. 'scipy.ndimage'
+    :return: a LazyModule importing the module on first use
+    """
+    return LazyModule(name)
+
+
+def is_instance(obj, module_name, class_names):
+    """
+    isinstance check against classes of a module, without importing the module:
+    if it was not imported yet, obj can not be an instance of its classes
+    :param obj: the object
+    :param module_name: the module name, e.g. 'pandas'
+    :param class_names: a class name or tuple of names, e.g. ('DataFrame', 'Series')
+    :return: True if obj is an instance of one of the classes
+    """
+    module = sys.modules.get(module_name)
+    if module is None:
+        return False
+    if isinstance(class_names, str):
+        class_names = (class_names,)
+    return isinstance(obj, tuple(getattr(module, c) for c in class_names))
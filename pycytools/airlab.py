@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Client for the Airlab API to query antibody clone infos
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_BASE_URL = 'http://airlaboratory.ch/apiLabPad/api/'
+
+
+class AirlabClient(object):
+    """
+    Queries the Airlab API with a pooled session and bounded concurrency.
+
+    Responses are cached in memory and, if a cache_dir is given, on disk,
+    such that repeated queries of the same ids do not need any network calls.
+    """
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, max_workers=8, cache_dir=None, ttl=7 * 24 * 3600, timeout=30):
+        """
+        :param base_url: the base url of the api, e.g. of a local test server
+        :param max_workers: maximal number of concurrent requests
+        :param cache_dir: optional, a folder to persistently cache the responses
+        :param ttl: time in seconds until a cached response expires, None to never expire
+        :param timeout: timeout in seconds for a single request
+        """
+        if not base_url.endswith('/'):
+            base_url = base_url + '/'
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.timeout = timeout
+        self._cache = dict()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _is_fresh(self, timestamp):
+        return (self.ttl is None) or ((time.time() - timestamp) < self.ttl)
+
+    def _cache_fn(self, id):
+        return os.path.join(self.cache_dir, 'clone_' + quote(str(id), safe='') + '.json')
+
+    def _read_cache(self, id):
+        """
+        :return: (True, response entry) if a fresh cached response exists, else (False, None)
+        """
+        if id in self._cache:
+            timestamp, resp_entry = self._cache[id]
+            if self._is_fresh(timestamp):
+                return True, resp_entry
+
+        if self.cache_dir is not None:
+            fn = self._cache_fn(id)
+            if os.path.exists(fn) and self._is_fresh(os.path.getmtime(fn)):
+                try:
+                    with open(fn) as f:
+                        resp_entry = json.load(f)
+                except ValueError:
+                    return False, None
+                self._cache[id] = (os.path.getmtime(fn), resp_entry)
+                return True, resp_entry
+
+        return False, None
+
+    def _write_cache(self, id, resp_entry):
+        self._cache[id] = (time.time(), resp_entry)
+        if self.cache_dir is not None:
+            fn = self._cache_fn(id)
+            tmp_fn = fn + '.tmp' + str(os.getpid())
+            with open(tmp_fn, 'w') as f:
+                json.dump(resp_entry, f)
+            os.replace(tmp_fn, fn)
+
+    def _fetch_clone_info(self, id):
+        resp = self.session.get(self.base_url + 'getInfoForClone/' + str(id), timeout=self.timeout)
+        resp.raise_for_status()
+        return json.loads(resp.text)
+
+    def query_clone_infos(self, ids):
+        """
+        Query clone info from clone ids
+        :param ids: clone ids, duplicates are only queried once
+        :return: dict with the response
+        """
+        uni_ids = list(dict.fromkeys(ids))
+
+        resp_entries = dict()
+        missing_ids = list()
+        for id in uni_ids:
+            is_cached, resp_entry = self._read_cache(id)
+            if is_cached:
+                resp_entries[id] = resp_entry
+            else:
+                missing_ids.append(id)
+
+        if len(missing_ids) > 0:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing_ids))) as pool:
+                for id, resp_entry in zip(missing_ids, pool.map(self._fetch_clone_info, missing_ids)):
+                    self._write_cache(id, resp_entry)
+                    resp_entries[id] = resp_entry
+
+        resp_dict = dict()
+        for id in uni_ids:
+            resp_entry = resp_entries[id]
+            if (resp_entry != '0') & (len(resp_entry) > 0):
+                resp_dict[id] = resp_entry[0]
+        return resp_dict
+
+
+_default_client = None
+
+
+def get_default_client():
+    """
+    :return: the AirlabClient used by the pycytools.library airlab functions
+    """
+    global _default_client
+    if _default_client is None:
+        _default_client = AirlabClient()
+    return _default_client
+
+
+def set_default_client(client):
+    """
+    Sets the AirlabClient used by the pycytools.library airlab functions,
+    e.g. to use a persistent cache or a different base url
+    :param client: an AirlabClient
+    """
+    global _default_client
+    _default_client = client
@@ -2,90 +2,149 @@
 # code initially adapted @markak on GitHub, algorithm is from
 # Ziv Bar-Joseph et al., Bioinformatics 2001
 
-import itertools
-
 import numpy as np
 from scipy.cluster import hierarchy
 from scipy.spatial import distance
 
 
-def order_tree(Z, rd, M):
-    def swap_subtrees(n):
-        n.right, n.left = n.left, n.right
-
-    for v in range(Z.shape[0] * 2, Z.shape[0], -1):
-        L, R = rd[v].left.pre_order(), rd[v].right.pre_order()
-        u, w = min(itertools.product(L, R),
-                   key=lambda u, w: M[v, u, w])
-
-        if rd[v].left.count > 1:
-            LR = rd[v].left.right.pre_order()
-            if u in LR:
-                swap_subtrees(rd[v].left)
-
-        if rd[v].right.count > 1:
-            RL = rd[v].right.left.pre_order()
-            if w in RL:
-                swap_subtrees(rd[v].right)
+def _leaf_ranges(Z):
+    # Z - linkage matrix from scipy.cluster.hierarchy
+    # returns for every node the start and size of its leaf range in the
+    # pre order of the unordered tree, and the leaf ids in this order
+    n_leaves = Z.shape[0] + 1
+    n_total = 2 * n_leaves - 1
+    size = np.ones(n_total, dtype=np.intp)
+    size[n_leaves:] = Z[:, 3]
+    start = np.zeros(n_total, dtype=np.intp)
+
+    # parents are visited before their children when iterating from the root down
+    for i in range(Z.shape[0] - 1, -1, -1):
+        v = n_leaves + i
+        j, k = int(Z[i, 0]), int(Z[i, 1])
+        start[j] = start[v]
+        start[k] = start[v] + size[j]
+
+    leaves = np.empty(n_leaves, dtype=np.intp)
+    leaves[start[:n_leaves]] = np.arange(n_leaves)
+    return start, size, leaves
+
+
+def _min_plus(X, Y):
+    # min-plus matrix product: out[a, b] = min_t X[a, t] + Y[t, b]
+    # loops over the smallest dimension, vectorizing the other two
+    p, q = X.shape
+    r = Y.shape[1]
+    if q <= p and q <= r:
+        out = X[:, 0:1] + Y[0:1, :]
+        for t in range(1, q):
+            np.minimum(out, X[:, t:(t + 1)] + Y[t:(t + 1), :], out=out)
+    elif p <= r:
+        out = np.empty((p, r))
+        for a in range(p):
+            out[a, :] = (X[a, :, np.newaxis] + Y).min(axis=0)
+    else:
+        out = np.empty((p, r))
+        for b in range(r):
+            out[:, b] = (X + Y[:, b]).min(axis=1)
+    return out
+
+
+def _min_plus3(X, Y, W):
+    # min-plus product of three matrices in the cheaper association
+    p, q = X.shape
+    r, s = Y.shape[1], W.shape[1]
+    if p * q * r + p * r * s <= q * r * s + p * q * s:
+        return _min_plus(_min_plus(X, Y), W)
+    return _min_plus(X, _min_plus(Y, W))
+
+
+def _child_splits(Z, v, start, size):
+    # returns the (this, that) pairs of leaf ranges of the children of node v,
+    # for a leaf this and that are the leaf itself
+    n_leaves = Z.shape[0] + 1
+    s = np.s_[start[v]:(start[v] + size[v])]
+    if v < n_leaves:
+        return [(s, s)]
+    j, k = int(Z[v - n_leaves, 0]), int(Z[v - n_leaves, 1])
+    L = np.s_[start[j]:(start[j] + size[j])]
+    R = np.s_[start[k]:(start[k] + size[k])]
+    return [(L, R), (R, L)]
 
 
 def optimal_scores(Z, rd, dists):
     # Z - linkage matrix from scipy.cluster.hierarchy
     # rd - ClusterNode dictionary from to_tree
     # dists - distance matrix
+    # returns M - M[u, w] is the minimal cost of ordering the subtree of the
+    # lowest common ancestor of u and w starting at u and ending at w.
+    # u and w are the leaf positions in the unordered tree, see _leaf_ranges
 
     n_nodes = Z.shape[0] + 1
-
-    M = {}
+    start, size, leaves = _leaf_ranges(Z)
+    D = np.asarray(dists, dtype=np.float64)[np.ix_(leaves, leaves)]
+    M = np.zeros((n_nodes, n_nodes))
 
     # iterating through the linkage matrix guarantees
     # we never see a node before its children
     for i in range(Z.shape[0]):
-        # linkage matrix starts at first non-leaf node
-        v = n_nodes + i
         # the left and right nodes
         j, k = int(Z[i, 0]), int(Z[i, 1])
 
-        if Z[i, 3] == 2:
-            # both j and k are leaves, so there is no ordering to be done
-            M[v, j, k] = M[v, k, j] = Z[i, 2]
-        elif rd[j].is_leaf():
-            # if j is a leaf, we calculate the distances to all
-            # subtrees of k
-            kwns = [kwn for kwn in M if kwn[0] == k]
-            for k, w, n in kwns:
-                M[v, j, n] = M[v, n, j] = M[k, w, n] + dists[j, w]
-                M[v, j, w] = M[v, w, j] = M[k, w, n] + dists[j, n]
-        elif rd[k].is_leaf():
-            # symmetrically if k is a leaf
-            jums = [jum for jum in M if jum[0] == j]
-            for j, u, m in jums:
-                M[v, m, k] = M[v, k, m] = M[j, u, m] + dists[k, u]
-                M[v, u, k] = M[v, k, u] = M[j, u, m] + dists[k, m]
-        else:
-            # neither j nor k are leaves, so we consider combinations of subtrees
-            LL, LR = rd[j].left.pre_order(), rd[j].right.pre_order()
-            RL, RR = rd[k].left.pre_order(), rd[k].right.pre_order()
-
-            for (this_L, that_L), (this_R, that_R) in itertools.product(((LL, LR), (LR, LL)),
-                                                                        ((RL, RR), (RR, RL))):
-                for u, w in itertools.product(this_L, this_R):
-                    m_order = sorted(that_L, key=lambda m: M[j, u, m])
-                    n_order = sorted(that_R, key=lambda n: M[k, w, n])
-                    C = dists[np.ix_(m_order, n_order)].min()
-                    Cmin = 1e10
-                    for m, n in itertools.product(m_order, n_order):
-                        if M[j, u, m] + M[k, w, n] + C >= Cmin:
-                            break
-                        C = M[j, u, m] + M[k, w, n] + dists[m, n]
-                        if C < Cmin:
-                            Cmin = C
-
-                    M[v, u, w] = M[v, w, u] = Cmin
+        for this_L, that_L in _child_splits(Z, j, start, size):
+            for this_R, that_R in _child_splits(Z, k, start, size):
+                # M[u, w] = min over m, n: M[u, m] + D[m, n] + M[n, w]
+                scores = _min_plus3(M[this_L, that_L], D[that_L, that_R], M[that_R, this_R])
+                M[this_L, this_R] = scores
+                M[this_R, this_L] = scores.T
 
     return M
 
 
+def order_tree(Z, rd, M, dists):
+    # Z - linkage matrix
+    # rd - ClusterNode dictionary from to_tree, modified in place
+    # M - the scores from optimal_scores
+    # dists - distance matrix
+    def swap_subtrees(n):
+        n.right, n.left = n.left, n.right
+
+    n_nodes = Z.shape[0] + 1
+    start, size, leaves = _leaf_ranges(Z)
+
+    def node_range(v):
+        return start[v], start[v] + size[v]
+
+    def children(v):
+        return int(Z[v - n_nodes, 0]), int(Z[v - n_nodes, 1])
+
+    def other_range(v, u):
+        # the leaf positions at the other end of the subtree v, when starting at u
+        for this, that in _child_splits(Z, v, start, size):
+            if this.start <= u < this.stop:
+                return np.arange(that.start, that.stop)
+
+    root = 2 * n_nodes - 2
+    j, k = children(root)
+    L, R = np.s_[slice(*node_range(j))], np.s_[slice(*node_range(k))]
+    u, w = np.unravel_index(np.argmin(M[L, R]), M[L, R].shape)
+    stack = [(root, u + L.start, w + R.start)]
+
+    while len(stack) > 0:
+        v, first, last = stack.pop()
+        if v < n_nodes:
+            continue
+        j, k = children(v)
+        if node_range(k)[0] <= first < node_range(k)[1]:
+            swap_subtrees(rd[v])
+            j, k = k, j
+
+        ms, ns = other_range(j, first), other_range(k, last)
+        C = M[first, ms][:, np.newaxis] + dists[np.ix_(leaves[ms], leaves[ns])] + M[ns, last][np.newaxis, :]
+        m, n = np.unravel_index(np.argmin(C), C.shape)
+        stack.append((j, first, ms[m]))
+        stack.append((k, ns[n], last))
+
+
 def optimal_ordering(Z, dists):
     # Z - linkage matrix
     # dists - the distance matrix
@@ -96,7 +155,7 @@ def optimal_ordering(Z, dists):
     # Generate scores
     M = optimal_scores(Z, rd, dists)
     # re-order the tree accordingly
-    order_tree(Z, rd, M)
+    order_tree(Z, rd, M, dists)
 
     # new leaf ordering
     row_reorder = tree.pre_order()
@@ -115,9 +174,9 @@ def plot_leaf_ordering(X, method, metric):
     t2, rd2 = hierarchy.to_tree(Z2, True)
 
     M = optimal_scores(Z, rd, dists)
-    order_tree(Z, rd, M)
+    order_tree(Z, rd, M, dists)
     M2 = optimal_scores(Z2, rd2, dists2)
-    order_tree(Z2, rd2, M2)
+    order_tree(Z2, rd2, M2, dists2)
 
     rr = t.pre_order()
     rr2 = t2.pre_order()
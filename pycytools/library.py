@@ -6,91 +6,412 @@ Contains various functions for image processing
 
 from __future__ import division
 
-import json
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 
 import numpy as np
-import pandas as pd
-import requests
-import scipy as sp
-import skimage as sk
-import tifffile
-import tifffile as tif
-from scipy import ndimage as ndi
-from skimage import filters
-from skimage import measure
-from skimage import morphology
-from skimage import transform
+from numpy.lib.mixins import NDArrayOperatorsMixin
+
+from pycytools import profiling
+from pycytools._lazy import lazy_import
+
+# heavy dependencies are only imported on first use
+pd = lazy_import('pandas')
+sk = lazy_import('skimage')
+tifffile = lazy_import('tifffile')
+tif = tifffile
+ndi = lazy_import('scipy.ndimage')
+sparse = lazy_import('scipy.sparse')
+spatial = lazy_import('scipy.spatial')
+filters = lazy_import('skimage.filters')
+morphology = lazy_import('skimage.morphology')
+transform = lazy_import('skimage.transform')
+airlab = lazy_import('pycytools.airlab')
+
+
+def _thread_map(fkt, items, n_jobs=1):
+    """
+    Applies a function to all items, with n_jobs > 1 in a thread pool
+    :param fkt: the function
+    :param items: iterable of items
+    :param n_jobs: number of threads, -1 to use all cores
+    :return: list of the results, in the order of the items
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            return list(pool.map(fkt, items))
+    return [fkt(item) for item in items]
+
+
+def _outlier_footprint():
+    footprint = np.ones((3, 3), dtype=bool)
+    footprint[1, 1] = False
+    return footprint
+
+
+def _median_at(img, rows, cols, footprint):
+    """
+    Median of the footprint neighbourhood at selected pixels, ignoring
+    pixels outside the image. As skimage.filters.rank.median the upper median is used.
+    :param img: 2D image
+    :param rows: row coordinates
+    :param cols: column coordinates
+    :param footprint: the neighbourhood footprint, centered
+    :return: the medians
+    """
+    d_rows, d_cols = np.nonzero(footprint)
+    n_rows = rows[:, np.newaxis] + d_rows - footprint.shape[0] // 2
+    n_cols = cols[:, np.newaxis] + d_cols - footprint.shape[1] // 2
+    is_in = (n_rows >= 0) & (n_rows < img.shape[0]) & (n_cols >= 0) & (n_cols < img.shape[1])
+    vals = img[np.clip(n_rows, 0, img.shape[0] - 1), np.clip(n_cols, 0, img.shape[1] - 1)].astype(np.float64)
+    vals[~is_in] = np.inf
+    vals.sort(axis=1)
+    return vals[np.arange(len(rows)), is_in.sum(axis=1) // 2]
+
+
+def _remove_outlier_pixels_2d(img, out, threshold, mode, footprint):
+    """
+    Removes outlier pixels of a single 2D image into out, which may be img itself
+    """
+    if mode == 'median':
+        if img.dtype in (np.uint8, np.uint16):
+            img_ref = filters.rank.median(img, footprint)
+        else:
+            img_ref = ndi.median_filter(img, footprint=footprint, mode='mirror')
+            # as rank.median, ignore the pixels outside the image at the border
+            border = np.ones(img.shape, dtype=bool)
+            border[(footprint.shape[0] // 2):(-(footprint.shape[0] // 2) or None),
+                   (footprint.shape[1] // 2):(-(footprint.shape[1] // 2) or None)] = False
+            rows, cols = np.nonzero(border)
+            img_ref[rows, cols] = _median_at(img, rows, cols, footprint)
+    elif mode == 'max':
+        if np.issubdtype(img.dtype, np.integer):
+            cval = np.iinfo(img.dtype).min
+        else:
+            cval = -np.inf
+        img_ref = ndi.maximum_filter(img, footprint=footprint, mode='constant', cval=cval)
+    else:
+        raise NameError('Mode must be: max or median')
+
+    # compare only where img > img_ref to avoid unsigned integer wrap around
+    imgfil = img > img_ref
+    imgfil[imgfil] = (img[imgfil] - img_ref[imgfil]) > threshold
+
+    if mode == 'median':
+        replacement = img_ref[imgfil]
+    else:
+        rows, cols = np.nonzero(imgfil)
+        replacement = _median_at(img, rows, cols, footprint).astype(img.dtype)
+
+    if out is not img:
+        out[...] = img
+    out[imgfil] = replacement
+    return out
 
 
 def remove_outlier_pixels(img, threshold=50, mode='median'):
-    mask = np.ones((3, 3))
-    mask[1, 1] = 0
-    img_median = filters.rank.median(img, mask)
-
-    if mode == 'max':
-        img_max = filters.rank.maximum(img, mask)
-        imgfil = (img - img_max) > threshold
-    elif mode == 'median':
-        imgfil = (img - img_median) > threshold
+    """
+    Replaces hot pixels by the median of their 8 neighbours
+    :param img: 2D image
+    :param threshold: pixels exceeding the median (mode='median') or maximum (mode='max')
+        of their neighbours by more than this are replaced
+    :param mode: 'median' or 'max'
+    :return: the corrected image
+    """
+    img_out = np.empty_like(img)
+    return _remove_outlier_pixels_2d(img, img_out, threshold, mode, _outlier_footprint())
+
+
+def remove_outlier_pixels_stack(img_stack, threshold=50, mode='median', channel_axis=0, out=None, n_jobs=1):
+    """
+    Removes hot pixels from all channels of an image stack, see remove_outlier_pixels.
+    Works with integer and float images.
+    :param img_stack: the image stack, CXY (channel_axis=0) or XYC (channel_axis=-1)
+    :param threshold: see remove_outlier_pixels
+    :param mode: 'median' or 'max'
+    :param channel_axis: 0 or -1
+    :param out: optional, the output array, can be img_stack itself for in place processing
+    :param n_jobs: number of threads processing the channels
+    :return: the corrected image stack
+    """
+    if out is None:
+        out = np.empty_like(img_stack)
     else:
-        raise ('Mode must be: max or median')
-    img_out = img.copy()
-    img_out[imgfil] = img_median[imgfil]
-    return img_out
+        assert out.shape == img_stack.shape, (out.shape, img_stack.shape)
 
+    in_chans = np.moveaxis(img_stack, channel_axis, 0)
+    out_chans = np.moveaxis(out, channel_axis, 0)
+    footprint = _outlier_footprint()
+
+    def process(c):
+        if out is img_stack:
+            img = in_chans[c].copy()
+        else:
+            img = in_chans[c]
+        _remove_outlier_pixels_2d(img, out_chans[c], threshold, mode, footprint)
 
-def scale_images(img, cap_percentile=99, rescale=False):
-    perc = np.percentile(img, cap_percentile)
-    img[img > perc] = perc
+    _thread_map(process, range(in_chans.shape[0]), n_jobs)
+    return out
+
+
+def scale_images(img, cap_percentile=99, rescale=False, cap=None):
+    """
+    Censors an image at a percentile
+    :param img: the image, modified in place
+    :param cap_percentile: the percentile to censor at
+    :param rescale: rescale the intensities to the full range
+    :param cap: optional, a precomputed cap used instead of the percentile,
+        e.g. from ChannelPercentiles
+    :return: the censored image
+    """
+    if cap is None:
+        cap = np.percentile(img, cap_percentile)
+    img[img > cap] = cap
     if rescale:
         img = sk.exposure.rescale_intensity(img)
     return img
 
 
-def normalize_images(img, **kwargs):
-    img = sk.exposure.equalize_hist(img, **kwargs)
+def scale_image_stack(img_stack, caps=None, cap_percentile=99, channel_axis=0, rescale=False, out=None):
+    """
+    Censors all channels of an image stack at per channel caps
+    :param img_stack: the image stack, CXY (channel_axis=0) or XYC (channel_axis=-1)
+    :param caps: optional, per channel caps, e.g. cohort wide from ChannelPercentiles.
+        If None, they are calculated from the histograms of this stack.
+    :param cap_percentile: the percentile to censor at if no caps are provided
+    :param channel_axis: 0 or -1
+    :param rescale: if True, the channels are divided by their caps, scaling them to [0, 1].
+        Channels with a cap of 0 are left at 0.
+    :param out: optional, the output array. Needs to be float if rescale is True.
+            Can be img_stack itself for in place processing.
+    :return: the censored image stack
+    """
+    if caps is None:
+        caps = ChannelPercentiles.from_stack(img_stack, channel_axis=channel_axis).percentile(cap_percentile)
+    if out is None:
+        out = np.empty(img_stack.shape, dtype=np.float32 if rescale else img_stack.dtype)
 
+    in_chans = np.moveaxis(img_stack, channel_axis, 0)
+    out_chans = np.moveaxis(out, channel_axis, 0)
+    for c, cap in enumerate(caps):
+        np.minimum(in_chans[c], cap, out=out_chans[c], casting='unsafe')
+        if rescale and (cap > 0):
+            out_chans[c] /= cap
+    return out
 
-def threshold_images(img, method='otsu',
-                     thresh_cor=None,
-                     thresh=None,
-                     fill=False,
-                     block_size=10,  # only for adaptive
-                     **kwargs):
-    if method.lower() == 'otsu':
-        thresh = filters.threshold_otsu(img)
 
-        if thresh_cor is None:
-            tresh_img = img > thresh
-        else:
-            tresh_img = img > thresh * thresh_cor
+class ChannelPercentiles(object):
+    """
+    Mergeable per channel histograms to calculate percentiles in a single pass.
+
+    8 and 16 bit integer images are counted per value, giving exact percentiles
+    as np.percentile. For other images a value_range is required and the percentiles
+    are interpolated within the histogram bins.
+    Accumulators of different images can be merged, e.g. to get cohort wide caps.
+    """
 
-    elif method.lower() == 'adaptive':
-        thresh = filters.threshold_adaptive(img,
-                                            block_size, **kwargs)
-        if thresh_cor is None:
-            tresh_img = img > thresh
+    def __init__(self, nchannels, value_range=None, bins=2 ** 16):
+        """
+        :param nchannels: the number of channels
+        :param value_range: (min, max) of the histogram for float images, None for exact integer counts
+        :param bins: the number of bins for float images
+        """
+        self.nchannels = nchannels
+        self.value_range = value_range
+        self.bins = bins
+        self.offset = 0
+        if value_range is None:
+            self.counts = np.zeros((nchannels, 0), dtype=np.int64)
         else:
-            tresh_img = img > thresh * thresh_cor
+            self.counts = np.zeros((nchannels, bins), dtype=np.int64)
+
+    @classmethod
+    def from_stack(cls, img_stack, channel_axis=0, value_range=None, bins=2 ** 16):
+        """
+        Creates the histograms of a single image stack
+        """
+        nchannels = img_stack.shape[channel_axis]
+        if (value_range is None) and not _is_exact_hist_dtype(img_stack.dtype):
+            value_range = (float(np.min(img_stack)), float(np.max(img_stack)))
+        hists = cls(nchannels, value_range=value_range, bins=bins)
+        hists.update(img_stack, channel_axis=channel_axis)
+        return hists
+
+    def update(self, img_stack, channel_axis=0):
+        """
+        Adds an image stack to the histograms
+        :param img_stack: the image stack, CXY (channel_axis=0) or XYC (channel_axis=-1)
+        :param channel_axis: 0 or -1
+        """
+        chans = np.moveaxis(img_stack, channel_axis, 0)
+        assert chans.shape[0] == self.nchannels, (chans.shape[0], self.nchannels)
+
+        if self.value_range is None:
+            if not _is_exact_hist_dtype(chans.dtype):
+                raise NameError('Exact histograms need 8 or 16 bit integer images, provide a value_range')
+            if np.issubdtype(chans.dtype, np.signedinteger):
+                self._set_offset(int(np.iinfo(chans.dtype).min))
+            for c in range(self.nchannels):
+                vals = chans[c].ravel()
+                if self.offset != 0:
+                    vals = vals.astype(np.intp) - self.offset
+                cnt = np.bincount(vals)
+                self._grow(len(cnt))
+                self.counts[c, :len(cnt)] += cnt
+        else:
+            for c in range(self.nchannels):
+                cnt, _ = np.histogram(np.clip(chans[c], *self.value_range), bins=self.bins, range=self.value_range)
+                self.counts[c] += cnt
+        return self
+
+    def merge(self, other):
+        """
+        Adds the histograms of another ChannelPercentiles
+        :param other: ChannelPercentiles with the same channels and binning
+        """
+        assert self.nchannels == other.nchannels
+        if self.value_range is None:
+            assert other.value_range is None
+            self._set_offset(other.offset)
+            self._grow(other.counts.shape[1] + (other.offset - self.offset))
+            start = other.offset - self.offset
+            self.counts[:, start:(start + other.counts.shape[1])] += other.counts
+        else:
+            assert (self.value_range == other.value_range) and (self.bins == other.bins)
+            self.counts += other.counts
+        return self
+
+    def _grow(self, nbins):
+        if nbins > self.counts.shape[1]:
+            self.counts = np.pad(self.counts, ((0, 0), (0, nbins - self.counts.shape[1])))
+
+    def _set_offset(self, offset):
+        if offset < self.offset:
+            self.counts = np.pad(self.counts, ((0, 0), (self.offset - offset, 0)))
+            self.offset = offset
+
+    def percentile(self, q):
+        """
+        Calculates per channel percentiles
+        :param q: the percentile, 0-100
+        :return: array with the percentile of every channel
+        """
+        cum = np.cumsum(self.counts, axis=1)
+        out = np.empty(self.nchannels)
+        for c in range(self.nchannels):
+            n = cum[c, -1]
+            if n == 0:
+                out[c] = np.nan
+                continue
+            pos = q / 100 * (n - 1)
+            lower = np.floor(pos)
+            if self.value_range is None:
+                # linear interpolation between the closest ranks, as np.percentile
+                v_lower = np.searchsorted(cum[c], lower, side='right')
+                v_upper = np.searchsorted(cum[c], min(lower + 1, n - 1), side='right')
+                out[c] = v_lower + (v_upper - v_lower) * (pos - lower) + self.offset
+            else:
+                # interpolate the rank within its bin
+                b = np.searchsorted(cum[c], pos, side='right')
+                prev = cum[c, b - 1] if b > 0 else 0
+                width = (self.value_range[1] - self.value_range[0]) / self.bins
+                out[c] = self.value_range[0] + width * (b + (pos - prev + 0.5) / self.counts[c, b])
+        return out
+
+
+def _is_exact_hist_dtype(dtype):
+    return np.issubdtype(dtype, np.integer) and (np.dtype(dtype).itemsize <= 2)
+
+
+def calc_channel_percentiles(img_stacks, q, channel_axis=0, value_range=None, bins=2 ** 16):
+    """
+    Calculates per channel percentiles across many image stacks in a single streaming pass
+    :param img_stacks: an iterable of image stacks, e.g. a generator loading them one by one
+    :param q: the percentile, 0-100
+    :param channel_axis: 0 or -1
+    :param value_range: see ChannelPercentiles
+    :param bins: see ChannelPercentiles
+    :return: array with the percentile of every channel
+    """
+    hists = None
+    for img_stack in img_stacks:
+        if hists is None:
+            hists = ChannelPercentiles(img_stack.shape[channel_axis], value_range=value_range, bins=bins)
+        hists.update(img_stack, channel_axis=channel_axis)
+    return hists.percentile(q)
+
+
+def normalize_images(img, **kwargs):
+    img = sk.exposure.equalize_hist(img, **kwargs)
+
 
-    elif method.lower() == 'manual':
+def _calc_threshold(img, method='otsu', thresh=None, block_size=11, **kwargs):
+    """
+    Calculates a global (scalar) or local (array) threshold
+    :param img: 2D image
+    :param method: otsu, adaptive or manual
+    :param thresh: the threshold for manual thresholding
+    :param block_size: only for adaptive, made odd if even
+    :return: the threshold
+    """
+    method = method.lower()
+    if method == 'otsu':
+        return filters.threshold_otsu(img)
+    elif method == 'adaptive':
+        return filters.threshold_local(img, block_size + 1 - block_size % 2, **kwargs)
+    elif method == 'manual':
         if thresh is None:
             raise NameError(
                 'when using manual thresholding, supply a threshold')
-
+        return thresh
     else:
         raise NameError('Invalid threshold method used')
 
+
+def threshold_images(img, method='otsu',
+                     thresh_cor=None,
+                     thresh=None,
+                     fill=False,
+                     block_size=11,  # only for adaptive
+                     **kwargs):
+    """
+    Thresholds an image
+    :param img: 2D image
+    :param method: otsu, adaptive (skimage.filters.threshold_local) or manual
+    :param thresh_cor: optional factor the threshold is multiplied with
+    :param thresh: the threshold for manual thresholding
+    :param fill: fill holes in the binary image
+    :param block_size: only for adaptive, made odd if even
+    :param kwargs: passed to threshold_local
+    :return: the binary image
+    """
+    thresh = _calc_threshold(img, method, thresh=thresh, block_size=block_size, **kwargs)
+    if thresh_cor is not None:
+        thresh = thresh * thresh_cor
+    tresh_img = img > thresh
+
     if fill:
-        tresh_img = sp.ndimage.binary_fill_holes(tresh_img)
+        tresh_img = ndi.binary_fill_holes(tresh_img)
 
     return tresh_img
 
 
 def keep_max_area(tresh_img):
-    lab = sk.measure.label(tresh_img)
-    labMax = np.bincount(lab[lab > 0]).argmax()
+    """
+    Keeps only the largest connected (8-connectivity) component of a binary image
+    :param tresh_img: binary image
+    :return: binary image with the largest component
+    """
+    lab, nlab = ndi.label(tresh_img, structure=np.ones((3, 3)))
+    if nlab == 0:
+        return np.zeros(lab.shape, dtype=bool)
+    labMax = np.bincount(lab.ravel(), minlength=nlab + 1)[1:].argmax() + 1
     tresh_img_max = lab == labMax
     return tresh_img_max
 
@@ -104,22 +425,158 @@ def flip_img(img, axis):
         raise NameError('Axis: 0: up down, 1:left right')
 
 
+def _binary_bbox(tresh_img):
+    """
+    Bounding box of the foreground of a binary image from its row and column projections
+    :param tresh_img: 2D binary image
+    :return: minr, minc, maxr, maxc, as the regionprops bbox
+    """
+    rows = np.flatnonzero(np.any(tresh_img, axis=1))
+    cols = np.flatnonzero(np.any(tresh_img, axis=0))
+    if len(rows) == 0:
+        return 0, 0, 0, 0
+    return rows[0], cols[0], rows[-1] + 1, cols[-1] + 1
+
+
 def crop_img_to_binary(img, tresh_img):
-    region = sk.measure.regionprops(tresh_img)
-    minr, minc, maxr, maxc = region[0].bbox
+    minr, minc, maxr, maxc = _binary_bbox(tresh_img)
 
     tresh_img = tresh_img[minr:maxr, minc:maxc]
     img = img[minr:maxr, minc:maxc]
     return (img, tresh_img)
 
 
+def _block_mean(img, factor):
+    """
+    Downsamples an image by averaging factor x factor blocks, the blocks at the
+    lower and right border may be smaller.
+    :param img: 2D image
+    :param factor: the block size
+    :return: the downsampled image
+    """
+    rows = np.arange(0, img.shape[0], factor)
+    cols = np.arange(0, img.shape[1], factor)
+    sums = np.add.reduceat(np.add.reduceat(img, rows, axis=0, dtype=np.float64), cols, axis=1)
+    counts = np.outer(np.diff(np.append(rows, img.shape[0])), np.diff(np.append(cols, img.shape[1])))
+    return sums / counts
+
+
+def _detect_tissue_single(img, method, thresh_cor, thresh, downscale, keep_max, fill, refine, block_size,
+                          **kwargs):
+    img = np.squeeze(img)
+    if downscale > 1:
+        coarse = _block_mean(img, downscale)
+    else:
+        coarse = img
+    coarse_thresh = _calc_threshold(coarse, method, thresh=thresh, block_size=block_size, **kwargs)
+    if thresh_cor is not None:
+        coarse_thresh = coarse_thresh * thresh_cor
+    coarse_mask = coarse > coarse_thresh
+    if keep_max:
+        coarse_mask = keep_max_area(coarse_mask)
+    if fill:
+        coarse_mask = ndi.binary_fill_holes(coarse_mask)
+    if downscale == 1:
+        return coarse_mask
+
+    height, width = img.shape
+    mask = np.repeat(np.repeat(coarse_mask, downscale, axis=0), downscale, axis=1)[:height, :width]
+    if refine:
+        # only the blocks along the border of the coarse mask are thresholded at full resolution
+        border = ndi.binary_dilation(coarse_mask) & ~ndi.binary_erosion(coarse_mask, border_value=1)
+        b_rows, b_cols = np.nonzero(border)
+        rows = np.broadcast_to((b_rows * downscale)[:, np.newaxis, np.newaxis] +
+                               np.arange(downscale)[np.newaxis, :, np.newaxis],
+                               (len(b_rows), downscale, downscale))
+        cols = np.broadcast_to((b_cols * downscale)[:, np.newaxis, np.newaxis] +
+                               np.arange(downscale)[np.newaxis, np.newaxis, :],
+                               (len(b_rows), downscale, downscale))
+        is_in = (rows < height) & (cols < width)
+        block_thresh = np.broadcast_to(coarse_thresh, coarse.shape)[b_rows, b_cols]
+        block_thresh = np.broadcast_to(block_thresh[:, np.newaxis, np.newaxis], rows.shape)
+        rows, cols = rows[is_in], cols[is_in]
+        mask[rows, cols] = img[rows, cols] > block_thresh[is_in]
+    return mask
+
+
+def detect_tissue(imgs, method='otsu', thresh_cor=None, thresh=None, downscale=16, keep_max=True, fill=True,
+                  refine=True, block_size=11, n_jobs=1, **kwargs):
+    """
+    Detects the tissue (foreground) of large images in a coarse to fine way.
+
+    The image is downsampled by block averaging, thresholded and the largest
+    component is selected (and holes filled) at the coarse level. Only the blocks along
+    the border of the coarse mask are thresholded again at full resolution.
+    For adaptive thresholding the local threshold of the coarse level is used,
+    thus block_size is in coarse pixels.
+
+    :param imgs: a 2D image, a stack of images (NXY) or a list of images, e.g. channels or sections
+    :param method: otsu, adaptive or manual, see threshold_images
+    :param thresh_cor: optional factor the threshold is multiplied with
+    :param thresh: the threshold for manual thresholding
+    :param downscale: the downsampling factor of the coarse level
+    :param keep_max: keep only the largest component
+    :param fill: fill the holes of the mask
+    :param refine: refine the border at full resolution, else the upsampled coarse mask is returned
+    :param block_size: only for adaptive, made odd if even
+    :param n_jobs: number of threads processing the images
+    :param kwargs: passed to threshold_local
+    :return: the binary mask(s), same form as imgs
+    """
+    is_single = isinstance(imgs, np.ndarray) and (imgs.ndim == 2)
+    if is_single:
+        img_list = [imgs]
+    else:
+        img_list = list(imgs)
+
+    def detect(img):
+        return _detect_tissue_single(img, method, thresh_cor, thresh, downscale, keep_max, fill, refine,
+                                     block_size, **kwargs)
+
+    masks = _thread_map(detect, img_list, n_jobs)
+
+    if is_single:
+        return masks[0]
+    elif isinstance(imgs, np.ndarray):
+        return np.stack(masks)
+    return masks
+
+
 def stretch_imgs_equal(img_list,
                        stretch_dim='w',  # w: widht, h: height, b: both
                        direction='min',  # min or max
-                       interpol=None  # which interpolation algorithm
+                       interpol=None,  # which interpolation algorithm
+                       out_dtype=None,
+                       anti_aliasing=None,
+                       preserve_range=False,
+                       batched=False,
+                       fill_value=0,
+                       n_jobs=1
                        ):
-    heights = np.array([float(img.shape[0]) for img in img_list])
-    widths = np.array([float(img.shape[1]) for img in img_list])
+    """
+    Stretches images to equal width and/or height.
+
+    Images can be 2D or multichannel with trailing channel dimensions (XYC),
+    all channels of an image are resized together.
+
+    :param img_list: list of images
+    :param stretch_dim: w: width, h: height, b: both
+    :param direction: min or max: stretch to the smallest or largest image
+    :param interpol: the interpolation order, 0-5, see skimage.transform.resize
+    :param out_dtype: the output dtype, e.g. np.float32, defaults to float64.
+            For integer dtypes (e.g. the input dtype) the value range is preserved and
+            the values are rounded and clipped to the dtype.
+    :param anti_aliasing: anti aliasing when downscaling, see skimage.transform.resize
+    :param preserve_range: keep the original value range, see skimage.transform.resize.
+            Always True for integer out_dtype.
+    :param batched: if True a single array of shape (nimgs, h, w, ...) is returned.
+            Images smaller than the largest one are padded at the bottom/right with fill_value.
+    :param fill_value: the padding value in batched mode
+    :param n_jobs: number of threads resizing the images
+    :return: list of stretched images or in batched mode a single array
+    """
+    heights = np.array([img.shape[0] for img in img_list], dtype=np.float64)
+    widths = np.array([img.shape[1] for img in img_list], dtype=np.float64)
 
     if direction == 'min':
         w_ref = widths.min()
@@ -129,26 +586,54 @@ def stretch_imgs_equal(img_list,
         w_ref = widths.max()
         h_ref = heights.max()
 
+    else:
+        raise NameError('direction must be min or max')
+
     if stretch_dim == 'w':
         w_scale = widths / float(w_ref)
         h_scale = w_scale
 
-    if stretch_dim == 'h':
+    elif stretch_dim == 'h':
         h_scale = heights / float(h_ref)
         w_scale = h_scale
 
-    if stretch_dim == 'b':
+    elif stretch_dim == 'b':
         h_scale = heights / float(h_ref)
         w_scale = widths / float(w_ref)
 
-    widths = np.floor(widths / w_scale)
-    heights = np.floor(heights / h_scale)
+    else:
+        raise NameError('stretch_dim must be w, h or b')
+
+    # the small offset avoids flooring e.g. 59.99999 to 59
+    widths = np.floor(widths / w_scale + 1e-6).astype(int)
+    heights = np.floor(heights / h_scale + 1e-6).astype(int)
+
+    if out_dtype is None:
+        out_dtype = np.float64
+    # skimage rescales to [0, 1] otherwise, which would be truncated to 0
+    is_int_out = np.issubdtype(out_dtype, np.integer)
+    if is_int_out:
+        preserve_range = True
+
+    if batched:
+        out_shape = (len(img_list), heights.max(), widths.max()) + img_list[0].shape[2:]
+        out_imgs = np.full(out_shape, fill_value, dtype=out_dtype)
+    else:
+        out_imgs = [None] * len(img_list)
+
     # stretch everything to max widht/maxheight
-    out_imgs = list()
-    for (img, w, h) in zip(img_list, widths, heights):
-        # do the rescaling
-        img = sk.transform.resize(img, (h, w))
-        out_imgs.append(img)
+    def process(i):
+        img = sk.transform.resize(img_list[i], (heights[i], widths[i]), order=interpol,
+                                  anti_aliasing=anti_aliasing, preserve_range=preserve_range)
+        if is_int_out:
+            info = np.iinfo(out_dtype)
+            img = np.clip(np.rint(img), info.min, info.max)
+        if batched:
+            out_imgs[i, :heights[i], :widths[i]] = img
+        else:
+            out_imgs[i] = img.astype(out_dtype, copy=False)
+
+    _thread_map(process, range(len(img_list)), n_jobs)
     return out_imgs
 
 
@@ -157,47 +642,83 @@ def blur_img_gauss(img, sigma=1, idKeys=None):
     return blur_img
 
 
-def l2l_corr(img, dim=0):
-    '''Calculates the line to line correlations between all lines of an image,
-    represented as a 2D matrix img'''
-    if dim == 0:
-        img = img.T
+def _normalize_lines(lines):
+    """
+    Centers and scales lines (rows of a 2D array) to unit norm, constant lines get NaN
+    """
+    lines = lines.astype(np.float64)
+    lines -= lines.mean(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lines /= np.sqrt(np.einsum('ij,ij->i', lines, lines))[:, np.newaxis]
+    return lines
 
-    nCol = img.shape[1]
-    corrArray = np.zeros(nCol - 1)
 
-    for i in range(nCol - 1):
-        corrArray[i] = np.corrcoef(img[:, i], img[:, i + 1])[1, 0]
+def l2l_corr(img, dim=0, lag=1, chunk_size=None):
+    '''Calculates the line to line correlations between all lines of an image,
+    represented as a 2D matrix img
+
+    :param img: 2D image, e.g. a memory mapped array
+    :param dim: 0: correlations between rows, 1: between columns
+    :param lag: distance between the correlated lines
+    :param chunk_size: optional, number of lines processed at once, to limit the memory
+    :return: array of the correlations between line i and line i + lag'''
+    lines = np.moveaxis(img, dim, 0)
+    nlines = lines.shape[0]
+    if chunk_size is None:
+        chunk_size = nlines
+
+    corrArray = np.empty(max(nlines - lag, 0))
+    for start in range(0, nlines - lag, chunk_size):
+        stop = min(start + chunk_size, nlines - lag)
+        z = _normalize_lines(np.asarray(lines[start:(stop + lag)]))
+        corrArray[start:stop] = np.einsum('ij,ij->i', z[:(stop - start)], z[lag:])
     return (corrArray)
 
 
+def l2l_corr_stack(img_stack, dim=0, lag=1, channel_axis=0, chunk_size=None, n_jobs=1):
+    """
+    Calculates the line to line correlations of all channels of an image stack, see l2l_corr
+    :param img_stack: the image stack, CXY (channel_axis=0) or XYC (channel_axis=-1)
+    :param dim: 0: correlations between rows, 1: between columns
+    :param lag: distance between the correlated lines
+    :param channel_axis: 0 or -1
+    :param chunk_size: optional, number of lines processed at once
+    :param n_jobs: number of threads processing the channels
+    :return: array of shape (nchannels, nlines - lag)
+    """
+    chans = np.moveaxis(img_stack, channel_axis, 0)
+
+    def process(c):
+        return l2l_corr(chans[c], dim=dim, lag=lag, chunk_size=chunk_size)
+
+    corrs = _thread_map(process, range(chans.shape[0]), n_jobs)
+    return np.stack(corrs)
+
+
 ### tools for dealing with segmentation masks
 
 
-def query_clone_infos_airlab(ids):
+def query_clone_infos_airlab(ids, client=None):
     """
     Use rauls API to query clone info from clone ids
     :param ids:
+    :param client: optional, an airlab.AirlabClient, defaults to airlab.get_default_client()
     :return: dict with the response
     """
+    if client is None:
+        client = airlab.get_default_client()
 
-    resp_dict = dict()
-    for id in ids:
-        resp = requests.get('http://airlaboratory.ch/apiLabPad/api/getInfoForClone/' + str(id))
-        resp_entry = json.loads(resp.text)
-        if (resp_entry != '0') & (len(resp_entry) > 0):
-            resp_dict[id] = resp_entry[0]
-
-    return resp_dict
+    return client.query_clone_infos(ids)
 
 
-def query_clone_names_airlab(ids, name_fields=['proName', "cloBindingRegion"], sep=' - '):
+def query_clone_names_airlab(ids, name_fields=['proName', "cloBindingRegion"], sep=' - ', client=None):
     """
     Queryis Rauls API for the clone name
     :param ids:
+    :param client: optional, an airlab.AirlabClient
     :return:
     """
-    resp_dict = query_clone_infos_airlab(ids)
+    resp_dict = query_clone_infos_airlab(ids, client=client)
 
     out_names = list()
     for id in ids:
@@ -245,16 +766,17 @@ def get_id_from_airlabname(name):
     return newname
 
 
-def get_names_from_airlabnames(names):
+def get_names_from_airlabnames(names, client=None):
     """
     Tries to query a nice airlab name based on the id in the name.
     If query not successfull the old name is returned.
     :param names:
+    :param client: optional, an airlab.AirlabClient
     :return:
     """
     ids = [get_id_from_airlabname(n) for n in names]
 
-    al_names = query_clone_names_airlab(ids)
+    al_names = query_clone_names_airlab(ids, client=client)
 
     namedict = {name: al_name for name, al_name in zip(names, al_names) if al_name is not None}
 
@@ -269,47 +791,121 @@ def find_touching_pixels(label_img, distance=1, selem=None):
     """
     Returns a mask indicating touching regions. Either provide a diameter for a disk shape
     distance or a selem mask.
+
+    The labels are propagated through the foreground as grey level maximum and minimum,
+    thus the runtime is independent of the number of labels.
+
     :param label_img: a label image with integer labels
     :param distance: =1: touching pixels, >1 pixels labels distance appart
     :param selem: optional, a selection mask, e.g. skimage.morphology.disk(1) (if this is bigger than
                     1 the 'distance' is not true.
-    :return: a mask of the regions touching or are close up to a certain diameter
+    :return: a boolean mask of the regions touching or are close up to a certain diameter
     """
 
     if selem is None:
         selem = morphology.disk(1)
+    # orient the footprint as the structuring element of a dilation
+    footprint = np.asarray(selem, dtype=bool)[::-1, ::-1]
+
+    label_img = np.asarray(label_img)
+    if not np.issubdtype(label_img.dtype, np.integer):
+        label_img = label_img.astype(np.int64)
+    bg = label_img <= 0
+    no_lab = np.iinfo(label_img.dtype).max
+    if label_img.max(initial=0) == no_lab:
+        label_img = label_img.astype(np.int64)
+        no_lab = np.iinfo(np.int64).max
+
+    # the maximal and minimal label reaching each pixel within 'distance' steps
+    lab_max = np.where(bg, 0, label_img)
+    lab_min = np.where(bg, no_lab, label_img)
+    for _ in range(distance):
+        lab_max = ndi.maximum_filter(lab_max, footprint=footprint, mode='constant', cval=0)
+        lab_min = ndi.minimum_filter(lab_min, footprint=footprint, mode='constant', cval=no_lab)
+        lab_max[bg] = 0
+        lab_min[bg] = no_lab
+
+    touch_mask = ((lab_max != 0) & (lab_max != label_img)) | ((lab_min != no_lab) & (lab_min != label_img))
+    touch_mask &= ~bg
+    return touch_mask
 
-    touch_mask = np.zeros(label_img.shape)
-    not_bg = label_img > 0
 
-    for i in np.unique(label_img):
-        if i != 0:
-            cur_lab = (label_img == i)
-            # touch_mask[ndi.filters.maximum_filter(cur_lab,  footprint=selem) &
-            #           not_bg & (cur_lab == False)] = 1
+def _nearest_index(n_in, n_out):
+    """
+    Integer source indices of a nearest neighbour rescaling from n_in to n_out pixels,
+    taken at the pixel centers
+    """
+    return ((2 * np.arange(n_out, dtype=np.int64) + 1) * n_in) // (2 * n_out)
 
-            touch_mask[ndi.binary_dilation(cur_lab, structure=selem, iterations=distance, mask=not_bg) &
-                       (cur_lab == False)] = 1
-
-    return touch_mask
 
+def _majority_blocks(blocks):
+    """
+    Most frequent value of every row, ties go to the smallest value
+    :param blocks: 2D array, one block per row
+    :return: 1D array with the majority per row
+    """
+    nblocks, blocksize = blocks.shape
+    blocks = np.sort(blocks, axis=1)
+    is_start = np.ones(blocks.shape, dtype=bool)
+    is_start[:, 1:] = blocks[:, 1:] != blocks[:, :-1]
+    run_id = np.cumsum(is_start, axis=1) - 1
+    flat_run = (np.arange(nblocks)[:, np.newaxis] * blocksize + run_id).ravel()
+    run_counts = np.bincount(flat_run, minlength=nblocks * blocksize).reshape(nblocks, blocksize)
+    run_vals = np.zeros_like(blocks)
+    run_vals.ravel()[flat_run] = blocks.ravel()
+    return run_vals[np.arange(nblocks), run_counts.argmax(axis=1)]
+
+
+def scale_labelmask(labelmask, scale, mode='nearest'):
+    """
+    Rescales a label mask without interpolating the label values.
 
-def scale_labelmask(labelmask, scale):
-    # assert (scaling % 1) == 0, "only integer scaling supported!"
+    Only index arithmetic is used, the output keeps the integer dtype of the input.
 
-    # rescale
-    trans_labs = transform.rescale(labelmask + 1, scale=scale, preserve_range=True)
+    :param labelmask: 2D label image
+    :param scale: scale factor, either a single one or one per dimension
+    :param mode: 'nearest': nearest neighbour up or downscaling,
+                 'majority': downscaling by an integer factor, taking the most frequent label per block
+    :return: the scaled label mask, of shape round(labelmask.shape * scale)
+    """
+    scale = np.broadcast_to(np.asarray(scale, dtype=np.float64), (2,))
+    out_shape = [max(int(np.round(n * s)), 1) for n, s in zip(labelmask.shape, scale)]
+
+    if mode == 'nearest':
+        idx_r = _nearest_index(labelmask.shape[0], out_shape[0])
+        idx_c = _nearest_index(labelmask.shape[1], out_shape[1])
+        return labelmask[np.ix_(idx_r, idx_c)]
+
+    elif mode == 'majority':
+        factors = [int(np.round(1 / s)) for s in scale]
+        if any((f < 1) or not np.isclose(f * s, 1) for f, s in zip(factors, scale)):
+            raise NameError("mode 'majority' only supports downscaling by integer factors")
+
+        # pad by edge replication or crop to full blocks
+        idx_r = np.minimum(np.arange(out_shape[0] * factors[0]), labelmask.shape[0] - 1)
+        idx_c = np.minimum(np.arange(out_shape[1] * factors[1]), labelmask.shape[1] - 1)
+        blocks = labelmask[np.ix_(idx_r, idx_c)]
+        blocks = blocks.reshape(out_shape[0], factors[0], out_shape[1], factors[1]).transpose(0, 2, 1, 3)
+        blocks = blocks.reshape(out_shape[0] * out_shape[1], factors[0] * factors[1])
+        return _majority_blocks(blocks).reshape(out_shape)
 
-    trans_labs[(trans_labs % 1) > 0] = 1
-    trans_labs = np.round(trans_labs) - 1
-    #
-    tmplabels = ndi.uniform_filter(trans_labs, size=2)
-    trans_labs[trans_labs != tmplabels] = 0
+    else:
+        raise NameError("mode must be 'nearest' or 'majority'")
 
-    return trans_labs.astype(np.int)
 
+def extract_mean_markers_by_mask(label_image, img_stack, tile_shape=None):
+    """
+    Calculates the mean intensity of all labels for all channels
+    :param label_image: a label image with integer labels
+    :param img_stack: the image stack, should be CXY
+    :param tile_shape: optional, process the images in tiles of this shape, see calc_label_stats_tiled
+    :return: dict with key=label and entry=array of channel means
+    """
+    if tile_shape is not None:
+        labels, stats = calc_label_stats_tiled(label_image, img_stack, ['mean'], tile_shape=tile_shape,
+                                               channel_axis=0)
+        return {label: stats[i, :, 0] for i, label in enumerate(labels.tolist())}
 
-def extract_mean_markers_by_mask(label_image, img_stack):
     label_image = np.squeeze(label_image)
     label_dict = dict()
     objects = ndi.find_objects(label_image)
@@ -326,99 +922,509 @@ def extract_mean_markers_by_mask(label_image, img_stack):
     return label_dict
 
 
-def apply_functions_to_labels(label_image, img_stack, fkt_list, out_array=None):
+LABEL_STATS = ('count', 'sum', 'mean', 'var', 'std', 'min', 'max', 'median')
+
+
+def _parse_label_stat(stat):
+    """
+    Checks a statistic name for calc_label_stats
+    :param stat: one of LABEL_STATS or 'q<percentile>', e.g. 'q99' or 'q2.5'
+    :return: the quantile (0-1) for quantile statistics, else None
     """
+    if stat in LABEL_STATS:
+        return None
+    if stat.startswith('q'):
+        try:
+            perc = float(stat[1:])
+        except ValueError:
+            perc = -1
+        if 0 <= perc <= 100:
+            return perc / 100
+    raise NameError('Invalid label statistic: ' + str(stat) +
+                    ', use one of ' + ', '.join(LABEL_STATS) + " or 'q<percentile>'")
 
-    :param label_img:
-    :param img_stack:
-    :param fkt_dict: dict key: fkt_name, value: function of the form fkt(mask, img)
-    :return:
+
+def _group_label_pixels(label_image):
+    """
+    Groups the foreground pixels of a label image by label, using a single stable sort
+    :param label_image: a label image with integer labels, 0 is background
+    :return: labels, order, starts, counts: the sorted unique labels, the flat pixel indices
+        sorted by label, the start of each label in order and the number of pixels per label
+    """
+    lab = np.ravel(label_image)
+    fg = np.flatnonzero(lab > 0)
+    order = fg[np.argsort(lab[fg], kind='stable')]
+    lab_sorted = lab[order]
+    is_start = np.ones(len(order), dtype=bool)
+    is_start[1:] = lab_sorted[1:] != lab_sorted[:-1]
+    starts = np.flatnonzero(is_start)
+    counts = np.diff(np.append(starts, len(order)))
+    return lab_sorted[starts], order, starts, counts
+
+
+def _calc_grouped_stats(vals, starts, counts, stat_list):
+    """
+    Calculates statistics of values grouped in consecutive segments
+    :param vals: 1D values, sorted by group
+    :param starts: start index of each group
+    :param counts: number of values per group (all >0)
+    :param stat_list: list of statistic names, see calc_label_stats
+    :return: array of shape (ngroups, nstats)
     """
+    out = np.empty((len(starts), len(stat_list)))
+    cache = dict()
+
+    def get_mean():
+        if 'mean' not in cache:
+            cache['mean'] = np.add.reduceat(vals, starts) / counts
+        return cache['mean']
+
+    def get_var():
+        if 'var' not in cache:
+            dev = vals - np.repeat(get_mean(), counts)
+            cache['var'] = np.add.reduceat(dev * dev, starts) / counts
+        return cache['var']
+
+    def get_sorted():
+        if 'sorted' not in cache:
+            groups = np.repeat(np.arange(len(starts)), counts)
+            cache['sorted'] = vals[np.lexsort((vals, groups))]
+        return cache['sorted']
+
+    for i, stat in enumerate(stat_list):
+        quant = _parse_label_stat(stat)
+        if stat == 'count':
+            out[:, i] = counts
+        elif stat == 'sum':
+            out[:, i] = np.add.reduceat(vals, starts)
+        elif stat == 'mean':
+            out[:, i] = get_mean()
+        elif stat == 'var':
+            out[:, i] = get_var()
+        elif stat == 'std':
+            out[:, i] = np.sqrt(get_var())
+        elif stat == 'min':
+            out[:, i] = np.minimum.reduceat(vals, starts)
+        elif stat == 'max':
+            out[:, i] = np.maximum.reduceat(vals, starts)
+        else:
+            if stat == 'median':
+                quant = 0.5
+            # linear interpolation between the closest ranks, as np.quantile
+            sorted_vals = get_sorted()
+            pos = quant * (counts - 1)
+            lower = np.floor(pos).astype(np.intp)
+            upper = np.minimum(lower + 1, counts - 1)
+            v_lower = sorted_vals[starts + lower]
+            v_upper = sorted_vals[starts + upper]
+            out[:, i] = v_lower + (v_upper - v_lower) * (pos - lower)
+    return out
+
+
+def calc_label_stats(label_image, img_stack, stat_list):
+    """
+    Calculates statistics of all labels for all channels at once.
+
+    In contrast to apply_functions_to_labels this does not loop over the objects,
+    but groups all pixels by label in a single pass.
+
+    :param label_image: a label image with integer labels, 0 is background
+    :param img_stack: the image stack, should be XYC
+    :param stat_list: list of statistic names: 'count', 'sum', 'mean', 'var', 'std',
+        'min', 'max', 'median' or 'q<percentile>' for arbitrary quantiles, e.g. 'q99'
+    :return: labels, stats: the sorted labels and an array of shape (nlabels, nchannels, nstats)
+    """
+    for stat in stat_list:
+        _parse_label_stat(stat)
 
     label_image = np.squeeze(label_image)
-    objects = ndi.find_objects(label_image)
+    labels, order, starts, counts = _group_label_pixels(label_image)
+    nchannels = img_stack.shape[2]
+    img_flat = np.reshape(img_stack, (-1, nchannels))
+
+    stats = np.empty((len(labels), nchannels, len(stat_list)))
+    if len(labels) > 0:
+        for c in range(nchannels):
+            vals = img_flat[order, c].astype(np.float64)
+            stats[:, c, :] = _calc_grouped_stats(vals, starts, counts, stat_list)
+    return labels, stats
+
+
+def apply_functions_to_labels(label_image, img_stack, fkt_list, out_array=None, tile_shape=None):
+    """
+    Applies functions to all labels and channels.
+
+    Statistic names (see calc_label_stats) are computed vectorized for all labels
+    at once, callables are applied object by object.
+
+    :param label_img:
+    :param img_stack: the image stack, should be XYC
+    :param fkt_list: list of statistic names or functions of the form fkt(mask, img)
+    :param out_array: optional, array of shape (nobj * nchannels, len(fkt_list) + 1)
+    :param tile_shape: optional, process the images in tiles of this shape,
+        only for statistic names, see calc_label_stats_tiled
+    :return: out_array: the label in the first column, the function results in the
+        following columns. Rows are ordered by label, then by channel.
+    """
 
-    objects = [(i + 1, sl) for i, sl in enumerate(objects) if sl is not None]
-    nobj = len(objects)
     nchannels = img_stack.shape[2]
+
+    stat_idx = [i for i, fkt in enumerate(fkt_list) if isinstance(fkt, str)]
+    fkt_idx = [i for i, fkt in enumerate(fkt_list) if not isinstance(fkt, str)]
+
+    if tile_shape is not None:
+        if len(fkt_idx) > 0:
+            raise NameError('Only statistic names can be calculated tile by tile')
+        labels, stats = calc_label_stats_tiled(label_image, img_stack, fkt_list, tile_shape=tile_shape)
+    else:
+        label_image = np.squeeze(label_image)
+        labels, stats = calc_label_stats(label_image, img_stack, [fkt_list[i] for i in stat_idx])
+    nobj = len(labels)
     out_shape = (nobj * nchannels, len(fkt_list) + 1)
     if out_array is None:
         out_array = np.empty(out_shape)
     else:
         assert out_array.shape == out_shape, (out_array.shape, out_shape)
 
-    for i, (label, sl) in enumerate(objects):
-        out_idx = np.s_[(i * nchannels):((i + 1) * nchannels)]
-
-        img_sl = img_stack[sl]
-        print(img_stack.shape, label_image.shape)
-        mask = label_image[sl] == label
-        sl_image = [img_sl[..., i] for i in range(img_sl.shape[2])]
-        t_out_array = out_array[out_idx]
-        x = np.array([[fkt(mask, img) for fkt in fkt_list] for img in sl_image])
-        t_out_array[:, 1:] = x
-        t_out_array[:, 0] = label
+    out_array[:, 0] = np.repeat(labels, nchannels)
+    if len(stat_idx) > 0:
+        out_array[:, [i + 1 for i in stat_idx]] = np.reshape(stats, (nobj * nchannels, len(stat_idx)))
+
+    if len(fkt_idx) > 0:
+        objects = ndi.find_objects(label_image)
+        objects = [(i + 1, sl) for i, sl in enumerate(objects) if sl is not None]
+        fkts = [fkt_list[i] for i in fkt_idx]
+        out_cols = [i + 1 for i in fkt_idx]
+        for i, (label, sl) in enumerate(objects):
+            out_idx = np.s_[(i * nchannels):((i + 1) * nchannels)]
+            img_sl = img_stack[sl]
+            mask = label_image[sl] == label
+            x = np.array([[fkt(mask, img_sl[..., c]) for fkt in fkts] for c in range(img_sl.shape[2])])
+            out_array[out_idx, out_cols] = x
 
     return out_array
 
 
-def apply_functions_to_list_of_labels(label_image_list, img_stack_list, fkt_list, out_array=None):
+TILED_LABEL_STATS = ('count', 'sum', 'mean', 'var', 'std', 'min', 'max')
+
+
+def open_tiff_lazy(fn):
     """
+    Opens a tiff file without reading it into memory.
 
-    :param ids:
-    :param label_image_list:
-    :param img_stack:
-    :param fkt_list:
-    :param out_array:
-    :return:
+    Uncompressed, contiguous files are memory mapped, others are opened as
+    zarr array (requires the optional zarr package).
+
+    :param fn: the filename
+    :return: an array like object supporting slicing
     """
+    try:
+        return tifffile.memmap(fn, mode='r')
+    except ValueError:
+        pass
+
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError(fn + ' can not be memory mapped, install zarr to read it tile by tile')
+    return zarr.open(tifffile.imread(fn, aszarr=True), mode='r')
 
-    nobjs = [len(np.unique(labs)) - 1 for labs in label_image_list]
+
+def calc_label_stats_tiled(label_image, img_stack, stat_list, tile_shape=(1024, 1024), channel_axis=-1):
+    """
+    Calculates statistics of all labels for all channels, reading the images tile by tile.
+
+    Per tile counts, means, sums of squared deviations, minima and maxima are merged
+    across tiles, thus labels spanning tile borders are handled correctly and the peak memory
+    is bounded by the tile size. Works with any sliceable array, e.g. from open_tiff_lazy.
+
+    :param label_image: a label image with integer labels, 0 is background
+    :param img_stack: the image stack
+    :param stat_list: list of statistic names: 'count', 'sum', 'mean', 'var', 'std', 'min', 'max'
+    :param tile_shape: the shape of the tiles
+    :param channel_axis: the channel axis of img_stack, 0 or -1
+    :return: labels, stats: as calc_label_stats
+    """
+    for stat in stat_list:
+        if stat not in TILED_LABEL_STATS:
+            raise NameError('Invalid tiled label statistic: ' + str(stat) +
+                            ', use one of ' + ', '.join(TILED_LABEL_STATS))
+
+    img_shape = label_image.shape[-2:]
+    if channel_axis == 0:
+        nchannels = img_stack.shape[0]
+    else:
+        nchannels = img_stack.shape[-1]
+
+    count = np.zeros(0, dtype=np.int64)
+    mean, m2, lab_min, lab_max = [np.zeros((0, nchannels)) for _ in range(4)]
+
+    for r in range(0, img_shape[0], tile_shape[0]):
+        for c in range(0, img_shape[1], tile_shape[1]):
+            sl = np.s_[r:(r + tile_shape[0]), c:(c + tile_shape[1])]
+            lab_tile = np.asarray(label_image[(Ellipsis,) + sl]).reshape(-1)
+            labels, order, starts, counts = _group_label_pixels(lab_tile)
+            if len(labels) == 0:
+                continue
+
+            if labels[-1] >= len(count):
+                # grow geometrically, raster ordered labels would otherwise copy the arrays for every tile
+                nadd = max(labels[-1] + 1, 2 * len(count)) - len(count)
+                count = np.append(count, np.zeros(nadd, dtype=np.int64))
+                mean, m2 = [np.append(x, np.zeros((nadd, nchannels)), axis=0) for x in (mean, m2)]
+                lab_min = np.append(lab_min, np.full((nadd, nchannels), np.inf), axis=0)
+                lab_max = np.append(lab_max, np.full((nadd, nchannels), -np.inf), axis=0)
+
+            if channel_axis == 0:
+                img_tile = np.asarray(img_stack[(slice(None),) + sl]).reshape(nchannels, -1).T
+            else:
+                img_tile = np.asarray(img_stack[sl]).reshape(-1, nchannels)
+
+            t_stats = np.empty((len(labels), nchannels, 4))
+            for ch in range(nchannels):
+                vals = img_tile[order, ch].astype(np.float64)
+                t_stats[:, ch, :] = _calc_grouped_stats(vals, starts, counts, ['mean', 'var', 'min', 'max'])
+
+            # merge the moments, Chan et al.
+            n_a = count[labels][:, np.newaxis]
+            n_b = counts[:, np.newaxis]
+            n = n_a + n_b
+            delta = t_stats[:, :, 0] - mean[labels]
+            mean[labels] += delta * n_b / n
+            m2[labels] += t_stats[:, :, 1] * n_b + delta ** 2 * n_a * n_b / n
+            lab_min[labels] = np.minimum(lab_min[labels], t_stats[:, :, 2])
+            lab_max[labels] = np.maximum(lab_max[labels], t_stats[:, :, 3])
+            count[labels] += counts
+
+    labels = np.flatnonzero(count)
+    n = count[labels][:, np.newaxis]
+    stat_dict = {'count': np.broadcast_to(n, (len(labels), nchannels)),
+                 'sum': mean[labels] * n,
+                 'mean': mean[labels],
+                 'var': m2[labels] / n,
+                 'std': np.sqrt(m2[labels] / n),
+                 'min': lab_min[labels],
+                 'max': lab_max[labels]}
+
+    stats = np.empty((len(labels), nchannels, len(stat_list)))
+    for i, stat in enumerate(stat_list):
+        stats[:, :, i] = stat_dict[stat]
+    return labels, stats
+
+
+def _apply_functions_to_shared_labels(shm_name, out_shape, out_idx, img_idx, label_image, img_stack, fkt_list):
+    """
+    Worker for apply_functions_to_list_of_labels: writes the results of one image
+    directly into the shared memory output array
+    :param shm_name: name of the shared memory block holding the output array
+    :param out_shape: shape of the float64 output array
+    :param out_idx: slice of the output rows for this image
+    :param img_idx: the image index written to the first column
+    :return: True
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out_array = np.ndarray(out_shape, dtype=np.float64, buffer=shm.buf)
+        t_out_array = out_array[out_idx, :]
+        t_out_array[:, 0] = img_idx
+        apply_functions_to_labels(label_image, img_stack, fkt_list, out_array=t_out_array[:, 1:])
+        del out_array, t_out_array
+    finally:
+        shm.close()
+    return True
+
+
+def apply_functions_to_list_of_labels(label_image_list, img_stack_list, fkt_list, out_array=None,
+                                      n_jobs=1, executor=None):
+    """
+    Applies functions to all labels and channels of a list of images,
+    see apply_functions_to_labels.
+
+    With n_jobs > 1 (or an executor) the images are distributed over worker processes,
+    which write their results directly into a shared memory output array.
+    In this case fkt_list needs to be picklable, e.g. statistic names or
+    module level functions, but no lambdas.
+
+    :param label_image_list: list of label images
+    :param img_stack_list: list of image stacks, should be XYC
+    :param fkt_list: list of statistic names or functions of the form fkt(mask, img)
+    :param out_array: optional, array of shape (nobj * nchannels, len(fkt_list) + 2)
+    :param n_jobs: number of worker processes, -1 to use all cores
+    :param executor: optional, a concurrent.futures executor to use instead of a new process pool
+    :return: out_array: the image index in the first column, the label in the second column,
+        the function results in the following columns
+    """
+
+    nobjs = [len(np.unique(labs[labs > 0])) for labs in label_image_list]
     nchannels = img_stack_list[0].shape[2]
     nfkts = len(fkt_list)
 
-    out_shape = (np.sum(nobjs) * nchannels, nfkts + 2)
+    out_shape = (int(np.sum(nobjs)) * nchannels, nfkts + 2)
 
     if out_array is None:
         out_array = np.empty(out_shape)
     else:
         assert (out_array.shape == out_shape)
 
+    out_idxs = list()
     last_idx = 0
-    for i, (labs, img_stack) in enumerate(zip(label_image_list, img_stack_list)):
-        next_idx = (last_idx + nobjs[i] * nchannels)
-        out_idx = np.s_[(last_idx):next_idx]
-        t_out_array = out_array[out_idx, :]
-        t_out_array[:, 0] = i
-        apply_functions_to_labels(labs, img_stack, fkt_list, out_array=t_out_array[:, 1:])
+    for nobj in nobjs:
+        next_idx = (last_idx + nobj * nchannels)
+        out_idxs.append(np.s_[(last_idx):next_idx])
         last_idx = next_idx
 
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+
+    if (executor is None) and ((n_jobs is None) or (n_jobs <= 1)):
+        for i, (labs, img_stack) in enumerate(zip(label_image_list, img_stack_list)):
+            t_out_array = out_array[out_idxs[i], :]
+            t_out_array[:, 0] = i
+            apply_functions_to_labels(labs, img_stack, fkt_list, out_array=t_out_array[:, 1:])
+        return out_array
+
+    nbytes = max(int(np.prod(out_shape)) * np.dtype(np.float64).itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    try:
+        if executor is None:
+            pool = ProcessPoolExecutor(max_workers=n_jobs)
+        else:
+            pool = executor
+        try:
+            futures = [pool.submit(_apply_functions_to_shared_labels, shm.name, out_shape, out_idxs[i], i,
+                                   labs, img_stack, fkt_list)
+                       for i, (labs, img_stack) in enumerate(zip(label_image_list, img_stack_list))]
+            for fut in futures:
+                fut.result()
+        finally:
+            if executor is None:
+                pool.shutdown()
+        shared_out = np.ndarray(out_shape, dtype=np.float64, buffer=shm.buf)
+        out_array[:] = shared_out
+        del shared_out
+    finally:
+        shm.close()
+        shm.unlink()
+
     return out_array
 
 
 def apply_functions_to_list_of_labels_table(label_image_list,
                                             img_stack_list, fkt_list, fkt_names,
-                                            channel_names, slice_ids=None):
+                                            channel_names, slice_ids=None, layout='wide',
+                                            dtype=np.float32, out_file=None):
     """
-
-    :param label_image_list:
-    :param img_stack_list:
-    :param fkt_list:
-    :param fkt_names:
-    :param channel_names:
-    :return:
+    Applies functions to all labels and channels of a list of images and
+    writes the results directly into the final table layout.
+
+    :param label_image_list: list of label images
+    :param img_stack_list: list of image stacks, should be XYC
+    :param fkt_list: list of statistic names or functions of the form fkt(mask, img),
+        see apply_functions_to_labels
+    :param fkt_names: the names of the functions
+    :param channel_names: the names of the channels
+    :param slice_ids: optional, ids of the images, default is the position in the list
+    :param layout: 'wide': one row per cell with (stat, channel) columns,
+                   'long': one row per cell and channel with one column per stat
+    :param dtype: the dtype of the statistics
+    :param out_file: optional, a parquet file the table is written to image by image
+        instead of returning it (requires pyarrow). Wide columns are named <stat>_<channel>.
+    :return: the table with a (cut_id, cell_id) or (cut_id, cell_id, channel) index,
+        or out_file if given
     """
-    dat = apply_functions_to_list_of_labels(label_image_list, img_stack_list, fkt_list)
-    dat = pd.DataFrame(dat, columns=['cut_id', 'cell_id'] + list(fkt_names))
-    dat['channel'] = np.tile(np.array(channel_names), dat.shape[0] / len(channel_names))
+    fkt_names = list(fkt_names)
+    channel_names = list(channel_names)
+    nchannels = len(channel_names)
+    nfkts = len(fkt_list)
+    if slice_ids is None:
+        slice_ids = np.arange(len(label_image_list))
+    slice_ids = np.asarray(slice_ids)
+
+    if layout == 'wide':
+        ncols = nfkts * nchannels
+        columns = pd.MultiIndex.from_product([fkt_names, channel_names], names=['stat', 'channel'])
+    elif layout == 'long':
+        ncols = nfkts
+        columns = pd.Index(fkt_names)
+    else:
+        raise NameError("layout must be 'wide' or 'long'")
+    nrows_per_obj = 1 if layout == 'wide' else nchannels
+
+    def calc_block(labs, img_stack):
+        # the block of one image: labels and statistics as (nrows, ncols)
+        stats = apply_functions_to_labels(labs, img_stack, fkt_list)
+        labels = stats[::nchannels, 0].astype(np.int64)
+        stats = stats[:, 1:].reshape(len(labels), nchannels, nfkts)
+        if layout == 'wide':
+            stats = stats.transpose(0, 2, 1)
+        return labels, stats.reshape(len(labels) * nrows_per_obj, ncols)
+
+    if out_file is not None:
+        _write_label_table_parquet(out_file, label_image_list, img_stack_list, calc_block, slice_ids,
+                                   fkt_names, channel_names, layout, dtype)
+        return out_file
+
+    nobjs = [len(np.unique(labs[labs > 0])) for labs in label_image_list]
+    nrows = int(np.sum(nobjs)) * nrows_per_obj
+    data = np.empty((nrows, ncols), dtype=dtype)
+    cut_ids = np.repeat(slice_ids, np.array(nobjs) * nrows_per_obj)
+    cell_ids = np.empty(nrows, dtype=np.int64)
+
+    last_idx = 0
+    for labs, img_stack in zip(label_image_list, img_stack_list):
+        labels, block = calc_block(labs, img_stack)
+        next_idx = last_idx + len(block)
+        data[last_idx:next_idx] = block
+        cell_ids[last_idx:next_idx] = np.repeat(labels, nrows_per_obj)
+        last_idx = next_idx
 
-    if slice_ids is not None:
-        slice_ids = np.array(slice_ids)
-        dat['cut_id'] = slice_ids[dat['cut_id']]
-    dat = dat.set_index(['cut_id', 'cell_id', 'channel'])
-    dat = dat.unstack(level='channel')
-    dat.columns.names = ['stat', 'channel']
-    return dat
+    if layout == 'wide':
+        index = pd.MultiIndex.from_arrays([cut_ids, cell_ids], names=['cut_id', 'cell_id'])
+    else:
+        channels = pd.Categorical.from_codes(np.tile(np.arange(nchannels), nrows // max(nchannels, 1)),
+                                             categories=channel_names)
+        index = pd.MultiIndex.from_arrays([cut_ids, cell_ids, channels], names=['cut_id', 'cell_id', 'channel'])
+    return pd.DataFrame(data, index=index, columns=columns, copy=False)
+
+
+def _write_label_table_parquet(out_file, label_image_list, img_stack_list, calc_block, slice_ids,
+                               fkt_names, channel_names, layout, dtype):
+    """
+    Writes the table of apply_functions_to_list_of_labels_table image by image to parquet
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Writing parquet files requires pyarrow')
+
+    nchannels = len(channel_names)
+    if layout == 'wide':
+        stat_cols = [f + '_' + str(c) for f in fkt_names for c in channel_names]
+    else:
+        stat_cols = list(fkt_names)
+
+    writer = None
+    try:
+        for slice_id, labs, img_stack in zip(slice_ids, label_image_list, img_stack_list):
+            labels, block = calc_block(labs, img_stack)
+            block = block.astype(dtype, copy=False)
+            nrows = len(block)
+            cols = {'cut_id': pa.array(np.repeat(slice_id, nrows)),
+                    'cell_id': pa.array(np.repeat(labels, nrows // max(len(labels), 1)))}
+            if layout == 'long':
+                cols['channel'] = pa.DictionaryArray.from_arrays(
+                    pa.array(np.tile(np.arange(nchannels, dtype=np.int32), len(labels))),
+                    pa.array([str(c) for c in channel_names]))
+            for i, col in enumerate(stat_cols):
+                cols[col] = pa.array(block[:, i])
+            table = pa.table(cols)
+            if writer is None:
+                writer = pq.ParquetWriter(out_file, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
 
 
 def extend_slice_touple(slice_touple, extent, max_dim, min_dim=(0, 0)):
@@ -470,6 +1476,117 @@ def add_slice_dimension(sl, append=True):
     return exsl
 
 
+def calc_label_centroids(label_image):
+    """
+    Calculates the centroids of all labels
+    :param label_image: a label image with integer labels, 0 is background
+    :return: labels, centroids: the sorted labels and an array of shape (nlabels, 2) with
+        the (row, column) centroids
+    """
+    label_image = np.squeeze(label_image)
+    labels, order, starts, counts = _group_label_pixels(label_image)
+    if len(labels) == 0:
+        return labels, np.empty((0, 2))
+    rows, cols = np.divmod(order, label_image.shape[1])
+    centroids = np.stack([np.add.reduceat(rows, starts), np.add.reduceat(cols, starts)], axis=1)
+    return labels, centroids / counts[:, np.newaxis]
+
+
+def _select_crop_centers(label_image, labels=None):
+    all_labels, centroids = calc_label_centroids(label_image)
+    if labels is not None:
+        labels = np.asarray(labels)
+        idx = np.minimum(np.searchsorted(all_labels, labels), max(len(all_labels) - 1, 0))
+        if (len(all_labels) == 0) or np.any(all_labels[idx] != labels):
+            raise KeyError('Not all labels are present in the label image')
+        all_labels, centroids = all_labels[idx], centroids[idx]
+    return all_labels, np.round(centroids).astype(np.intp)
+
+
+def _gather_cell_crops(label_image, img_stack, labels, centers, crop_shape, mask_neighbours, mask_background,
+                       pad_value, out):
+    """
+    Gathers the crops of a batch of labels into out (n, C, H, W). img_stack is XYC.
+    Pixels outside of the image are clipped in the index arrays and overwritten with
+    pad_value afterwards, thus the image is never padded.
+    """
+    img_h, img_w = label_image.shape
+    crop_h, crop_w = crop_shape
+    rows = centers[:, 0, np.newaxis] + np.arange(crop_h) - crop_h // 2
+    cols = centers[:, 1, np.newaxis] + np.arange(crop_w) - crop_w // 2
+    hide = ~(((rows >= 0) & (rows < img_h))[:, :, np.newaxis] &
+             ((cols >= 0) & (cols < img_w))[:, np.newaxis, :])
+    rows = np.clip(rows, 0, img_h - 1)[:, :, np.newaxis]
+    cols = np.clip(cols, 0, img_w - 1)[:, np.newaxis, :]
+
+    # (n, H, W, C) -> (n, C, H, W)
+    out[:] = np.moveaxis(img_stack[rows, cols], 3, 1)
+    if mask_neighbours or mask_background:
+        lab_crops = label_image[rows, cols]
+        if mask_neighbours:
+            hide |= (lab_crops != labels[:, np.newaxis, np.newaxis]) & (lab_crops != 0)
+        if mask_background:
+            hide |= lab_crops == 0
+    np.copyto(out, pad_value, where=hide[:, np.newaxis], casting='unsafe')
+    return out
+
+
+def iter_cell_crops(label_image, img_stack, crop_shape=(32, 32), batch_size=256, channel_axis=-1,
+                    mask_neighbours=False, mask_background=False, pad_value=0, labels=None, dtype=None):
+    """
+    Streams fixed size crops centered on the labels in batches, such that not all crops
+    need to be held in memory. See extract_cell_crops for the parameters.
+    :param batch_size: number of crops per batch
+    :return: generator yielding (labels, crops) with crops of shape (nbatch, C, H, W)
+    """
+    label_image = np.squeeze(label_image)
+    if channel_axis == 0:
+        img_stack = np.moveaxis(img_stack, 0, -1)
+    if dtype is None:
+        dtype = img_stack.dtype
+    labels, centers = _select_crop_centers(label_image, labels)
+    for start in range(0, len(labels), batch_size):
+        sl = slice(start, start + batch_size)
+        b_labels = labels[sl]
+        crops = np.empty((len(b_labels), img_stack.shape[-1]) + tuple(crop_shape), dtype=dtype)
+        yield b_labels, _gather_cell_crops(label_image, img_stack, b_labels, centers[sl], crop_shape,
+                                           mask_neighbours, mask_background, pad_value, crops)
+
+
+def extract_cell_crops(label_image, img_stack, crop_shape=(32, 32), channel_axis=-1, mask_neighbours=False,
+                       mask_background=False, pad_value=0, labels=None, dtype=None, batch_size=1024):
+    """
+    Extracts fixed size crops centered on the centroid of each label into a single
+    preallocated array, e.g. to feed a classifier.
+    Crops extending over the image border are padded with pad_value instead of truncated.
+    Use iter_cell_crops to stream the crops in batches instead.
+
+    :param label_image: a label image with integer labels, 0 is background
+    :param img_stack: the image stack, XYC (channel_axis=-1) or CXY (channel_axis=0)
+    :param crop_shape: (H, W) of the crops
+    :param channel_axis: -1 or 0
+    :param mask_neighbours: set the pixels of other labels to pad_value
+    :param mask_background: set the background pixels to pad_value
+    :param pad_value: value of the padded and masked pixels
+    :param labels: optional, the labels to crop. Default: all labels
+    :param dtype: the dtype of the crops. Default: the image dtype
+    :param batch_size: number of crops gathered at once, limits the size of the temporary arrays
+    :return: labels, crops: the labels and an array of shape (N, C, H, W)
+    """
+    label_image = np.squeeze(label_image)
+    if channel_axis == 0:
+        img_stack = np.moveaxis(img_stack, 0, -1)
+    if dtype is None:
+        dtype = img_stack.dtype
+    labels, centers = _select_crop_centers(label_image, labels)
+    crops = np.empty((len(labels), img_stack.shape[-1]) + tuple(crop_shape), dtype=dtype)
+    for start in range(0, len(labels), batch_size):
+        sl = slice(start, start + batch_size)
+        _gather_cell_crops(label_image, img_stack, labels[sl], centers[sl], crop_shape,
+                           mask_neighbours, mask_background, pad_value, crops[sl])
+    return labels, crops
+
+
 def map_series_on_mask(mask, series, label=None):
     """
     TODO: A good docstring here
@@ -495,59 +1612,218 @@ def map_series_on_mask(mask, series, label=None):
     return out_img
 
 
-def create_neightbourhood_dict(label_mask, bg_label=0):
+def create_neightbourhood_dict(label_mask, bg_label=0, connectivity=4):
     """
     Creates a dictionary indicating neightbourhood of cells
 
     :param label_mask:
+    :param bg_label: the background label, excluded from the neighbourhood
+    :param connectivity: 4 or 8, see make_neighbourhood_graph
     :return: nb_dict: a with key=label and entry=neightbour label
     """
 
-    vertices, edges = make_neighbourhood_graph(label_mask)
-    nb_dict = dict((v, list()) for v in vertices if v != bg_label)
+    vertices, adj = make_neighbourhood_graph(label_mask, output='sparse', connectivity=connectivity)
+    is_cell = vertices != bg_label
+    labels = vertices[is_cell]
+    adj = adj[is_cell][:, is_cell]
 
-    for e in edges:
-        if (e[0] != bg_label) & (e[0] != bg_label):
-            nb_dict[e[0]].append(e[1])
-            nb_dict[e[1]].append(e[0])
+    nbs = np.split(labels[adj.indices], adj.indptr[1:-1])
+    nb_dict = dict(zip(labels.tolist(), [nb.tolist() for nb in nbs]))
 
     return nb_dict
 
 
-def make_neighbourhood_graph(label_mask, uni_edges=True):
+def make_neighbourhood_graph(label_mask, uni_edges=True, output='list', connectivity=4, weighted=False):
     """
     Adapted from the internet
 
 
     :param label_mask:
+    :param uni_edges: if False, 'list' and 'array' outputs contain every edge in both directions
+    :param output: 'list': edges as list of [label, label] pairs,
+                   'array': edges as an (nedges, 2) array of labels,
+                   'sparse': a symmetric scipy.sparse CSR adjacency matrix indexed by the
+                        position of the labels in vertices
+    :param connectivity: 4: only horizontal and vertical contacts, 8: also diagonal contacts
+    :param weighted: if True the edge weights are the shared border length in pixel contacts.
+                    For 'list' and 'array' the weights are returned as an additional output,
+                    for 'sparse' they are the matrix entries.
     :return: vertices, edges: vertices and edges of the neighbourhood graph, includes  background labels
     """
-    # get unique labels
-    grid = label_mask
-    vertices = np.unique(grid)
-
-    # map unique labels to [1,...,num_labels]
-    # -> otherwise the hashing will not work
-    reverse_dict = dict(zip(vertices, np.arange(len(vertices))))
-    grid = np.array([reverse_dict[x] for x in grid.flat]).reshape(grid.shape)
+    # map unique labels to [0,...,num_labels-1]
+    vertices, grid = np.unique(label_mask, return_inverse=True)
+    grid = np.reshape(grid, np.shape(label_mask)).astype(np.int64)
+    num_vertices = len(vertices)
 
     # create edges
-    down = np.c_[grid[:-1, :].ravel(), grid[1:, :].ravel()]
-    right = np.c_[grid[:, :-1].ravel(), grid[:, 1:].ravel()]
-    all_edges = np.vstack([right, down])
-    all_edges = all_edges[all_edges[:, 0] != all_edges[:, 1], :]
-    all_edges = np.sort(all_edges, axis=1)
-    num_vertices = len(vertices)
-    edge_hash = all_edges[:, 0] + num_vertices * all_edges[:, 1]
+    pairs = [(grid[:-1, :], grid[1:, :]), (grid[:, :-1], grid[:, 1:])]
+    if connectivity == 8:
+        pairs += [(grid[:-1, :-1], grid[1:, 1:]), (grid[:-1, 1:], grid[1:, :-1])]
+    elif connectivity != 4:
+        raise NameError('connectivity must be 4 or 8')
+
+    first = np.concatenate([a.ravel() for a, b in pairs])
+    second = np.concatenate([b.ravel() for a, b in pairs])
+    is_edge = first != second
+    first, second = first[is_edge], second[is_edge]
     # find unique connections
-    edges = np.unique(edge_hash)
+    edge_hash = np.minimum(first, second) + num_vertices * np.maximum(first, second)
+    edge_hash, weights = np.unique(edge_hash, return_counts=True)
     # undo hashing
-    edges = [[vertices[x % num_vertices],
-              vertices[x / num_vertices]] for x in edges]
-
+    lo, hi = edge_hash % num_vertices, edge_hash // num_vertices
+
+    if output == 'sparse':
+        data = weights if weighted else np.ones(len(weights), dtype=np.int64)
+        adj = sparse.coo_matrix((np.concatenate([data, data]),
+                                 (np.concatenate([lo, hi]), np.concatenate([hi, lo]))),
+                                shape=(num_vertices, num_vertices)).tocsr()
+        return vertices, adj
+
+    if not uni_edges:
+        lo, hi = np.concatenate([lo, hi]), np.concatenate([hi, lo])
+        weights = np.concatenate([weights, weights])
+
+    edges = np.stack([vertices[lo], vertices[hi]], axis=1)
+    if output == 'list':
+        edges = edges.tolist()
+    elif output != 'array':
+        raise NameError("output must be 'list', 'array' or 'sparse'")
+
+    if weighted:
+        return vertices, edges, weights
     return vertices, edges
 
 
+def _label_boundary_points(label_mask, step=1):
+    """
+    Boundary pixels of all labels, subsampled to every step-th pixel per label
+    :param label_mask: 2D label image, 0 is background
+    :param step: subsampling step
+    :return: point_labels, points: the label and (row, column) coordinate of every point
+    """
+    is_border = np.zeros(label_mask.shape, dtype=bool)
+    diff = label_mask[1:, :] != label_mask[:-1, :]
+    is_border[1:, :] |= diff
+    is_border[:-1, :] |= diff
+    diff = label_mask[:, 1:] != label_mask[:, :-1]
+    is_border[:, 1:] |= diff
+    is_border[:, :-1] |= diff
+    is_border[[0, -1], :] = True
+    is_border[:, [0, -1]] = True
+    is_border &= label_mask != 0
+
+    rows, cols = np.nonzero(is_border)
+    point_labels = label_mask[rows, cols]
+    if step > 1:
+        order = np.argsort(point_labels, kind='stable')
+        point_labels = point_labels[order]
+        is_start = np.ones(len(order), dtype=bool)
+        is_start[1:] = point_labels[1:] != point_labels[:-1]
+        starts = np.flatnonzero(is_start)
+        rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.append(starts, len(order))))
+        keep = rank % step == 0
+        order, point_labels = order[keep], point_labels[keep]
+        rows, cols = rows[order], cols[order]
+    return point_labels, np.stack([rows, cols], axis=1)
+
+
+def _min_label_pairs(first, second, dists, nlabels):
+    """
+    Unique undirected label pairs with their minimal distance, self pairs are dropped
+    :param first: label positions
+    :param second: label positions
+    :param dists: the distances
+    :param nlabels: number of labels
+    :return: edge_hash, dists: the sorted pairs hashed as lower * nlabels + higher and their distance
+    """
+    is_nb = first != second
+    first, second, dists = first[is_nb], second[is_nb], dists[is_nb]
+    edge_hash = np.minimum(first, second).astype(np.int64) * nlabels + np.maximum(first, second)
+    order = np.lexsort((dists, edge_hash))
+    edge_hash, dists = edge_hash[order], dists[order]
+    is_first = np.ones(len(edge_hash), dtype=bool)
+    is_first[1:] = edge_hash[1:] != edge_hash[:-1]
+    return edge_hash[is_first], dists[is_first]
+
+
+def make_radius_neighbourhood_graph(label_mask, radius=None, k=None, mode='centroid', boundary_step=1,
+                                    pixel_size=1, output='sparse', weighted=False, chunk_size=8192):
+    """
+    Builds a neighbourhood graph of all labels within a radius or of the k nearest neighbours
+    by querying a KD-tree on the label centroids or boundary pixels instead of dilating the labels.
+
+    :param label_mask: 2D label image, 0 is background
+    :param radius: labels closer than radius are neighbours
+    :param k: alternatively to radius, the k nearest labels are neighbours (only mode 'centroid').
+        The graph is symmetrized, thus labels can have more than k neighbours.
+    :param mode: 'centroid': distances between the label centroids,
+                 'boundary': minimal distance between the boundary pixels of the labels
+    :param boundary_step: only for 'boundary', use every boundary_step-th boundary pixel per label
+    :param pixel_size: size of a pixel, e.g. to give the radius in um
+    :param output: 'sparse': (labels, adjacency) with a symmetric CSR matrix indexed by the position
+                        of the labels, as make_neighbourhood_graph(output='sparse') without background
+                   'dict': a neighbourhood dict as create_neightbourhood_dict
+    :param weighted: for 'sparse', the matrix entries are the distances instead of 1
+    :param chunk_size: number of points queried at once for radius neighbourhoods, limits the memory
+        used in 'boundary' mode
+    :return: the neighbourhood graph, see output
+    """
+    if (radius is None) == (k is None):
+        raise NameError('supply either a radius or k')
+    if output not in ('sparse', 'dict'):
+        raise NameError("output must be 'sparse' or 'dict'")
+    label_mask = np.squeeze(label_mask)
+
+    if mode == 'centroid':
+        labels, points = calc_label_centroids(label_mask)
+        point_idx = np.arange(len(labels))
+    elif mode == 'boundary':
+        if k is not None:
+            raise NameError("k nearest neighbours are only supported with mode 'centroid'")
+        point_labels, points = _label_boundary_points(label_mask, step=boundary_step)
+        labels, point_idx = np.unique(point_labels, return_inverse=True)
+    else:
+        raise NameError("mode must be 'centroid' or 'boundary'")
+    nlabels = len(labels)
+    points = points * pixel_size
+
+    if len(points) < 2:
+        edge_hash, dists = np.zeros(0, dtype=np.int64), np.zeros(0)
+    elif radius is not None:
+        tree = spatial.cKDTree(points)
+        # query in chunks of points, the number of point pairs can be large in 'boundary' mode
+        edge_hashs, chunk_dists = list(), list()
+        for start in range(0, len(points), chunk_size):
+            chunk_idx = np.arange(start, min(start + chunk_size, len(points)))
+            pairs = spatial.cKDTree(points[chunk_idx]).sparse_distance_matrix(tree, radius, output_type='ndarray')
+            first, second = chunk_idx[pairs['i']], pairs['j']
+            is_nb = first < second
+            e_hash, e_dists = _min_label_pairs(point_idx[first[is_nb]], point_idx[second[is_nb]],
+                                               pairs['v'][is_nb], nlabels)
+            edge_hashs.append(e_hash)
+            chunk_dists.append(e_dists)
+        edge_hash, dists = _min_label_pairs(np.concatenate(edge_hashs) // nlabels,
+                                            np.concatenate(edge_hashs) % nlabels,
+                                            np.concatenate(chunk_dists), nlabels)
+    else:
+        tree = spatial.cKDTree(points)
+        nbk = min(k + 1, len(points))
+        dists, nbs = tree.query(points, k=nbk)
+        edge_hash, dists = _min_label_pairs(np.repeat(np.arange(len(points)), nbk), nbs.ravel(), dists.ravel(),
+                                            nlabels)
+    lo, hi = edge_hash // nlabels, edge_hash % nlabels
+
+    data = dists if weighted else np.ones(len(dists), dtype=np.int64)
+    adj = sparse.coo_matrix((np.concatenate([data, data]),
+                             (np.concatenate([lo, hi]), np.concatenate([hi, lo]))),
+                            shape=(nlabels, nlabels)).tocsr()
+    if output == 'sparse':
+        return labels, adj
+
+    nbs = np.split(labels[adj.indices], adj.indptr[1:-1])
+    return dict(zip(labels.tolist(), [nb.tolist() for nb in nbs]))
+
+
 def save_object_stack(folder, basename, img_stack, slices):
     """
     Saves slices from an image stack as.
@@ -560,7 +1836,7 @@ def save_object_stack(folder, basename, img_stack, slices):
 
     for lab, sl in enumerate(slices):
         if sl is None:
-            pass
+            continue
         x = sl[0].start
         y = sl[1].start
 
@@ -575,6 +1851,96 @@ def save_object_stack(folder, basename, img_stack, slices):
                 tif.save(timg[chan, :, :].squeeze())
 
 
+def save_object_stack_bulk(fn, img_stack, slices, extent=0, compression='zlib', maxworkers=None):
+    """
+    Saves slices from an image stack into a single tiff file, one page per object
+    with the channels as samples.
+
+    An index table with the page, the file offset of the page (IFD) and the bounding box of
+    every object is saved next to it as fn + '.index.csv' to allow random access, see load_object_crop.
+
+    :param fn: the tiff filename
+    :param img_stack: the image stack. should be CXY
+    :param slices: a list of numpy slices sphecifying the regions to be saved,
+        e.g. from ndi.find_objects. The label of slices[i] is i+1, None entries are skipped.
+    :param extent: pixels to extend the slices by, see extend_slice_touple
+    :param compression: the tiff compression, e.g. 'zlib' or None
+    :param maxworkers: number of threads compressing the data of a page
+    :return: the index table
+    """
+    img_shape = img_stack.shape[1:]
+    index = list()
+
+    with tifffile.TiffWriter(fn, bigtiff=True) as tiff:
+        for lab, sl in enumerate(slices):
+            if sl is None:
+                continue
+            if extent > 0:
+                sl = extend_slice_touple(sl, extent, img_shape)
+
+            timg = np.ascontiguousarray(img_stack[add_slice_dimension(sl, append=False)])
+            if timg.shape[0] == 1:
+                # single channel pages are saved 2D, load_object_crops restores the channel axis
+                tiff.write(timg[0], photometric='minisblack', compression=compression,
+                           maxworkers=maxworkers, metadata=None)
+            else:
+                tiff.write(timg, photometric='minisblack', planarconfig='separate', compression=compression,
+                           maxworkers=maxworkers, metadata=None)
+            index.append((lab + 1, len(index), sl[0].start, sl[0].stop, sl[1].start, sl[1].stop))
+
+    index = pd.DataFrame(index, columns=['label', 'page', 'x_start', 'x_stop', 'y_start', 'y_stop'])
+    # a single pass over the page chain, such that single pages can be read without walking it
+    with tifffile.TiffFile(fn) as tiff:
+        index.insert(2, 'ifd_offset', np.array([page.offset for page in tiff.pages], dtype=np.int64))
+    index.to_csv(fn + '.index.csv', index=False)
+    return index
+
+
+def load_object_crops(fn, labels, index=None):
+    """
+    Loads object crops saved by save_object_stack_bulk, opening the file only once.
+    The pages are read directly at their offset from the index table.
+    :param fn: the tiff filename
+    :param labels: the object labels
+    :param index: optional, the index table, read from fn + '.index.csv' if not provided
+    :return: list of crops, CXY
+    """
+    if index is None:
+        index = pd.read_csv(fn + '.index.csv')
+
+    index = index.set_index('label')
+    missing = pd.Index(labels).difference(index.index)
+    if len(missing) > 0:
+        raise KeyError('Label ' + str(missing[0]) + ' not found in ' + fn)
+    entries = index.loc[list(labels)]
+
+    crops = list()
+    with tifffile.TiffFile(fn) as tiff:
+        for page_nr, ifd_offset in zip(entries['page'], entries.get('ifd_offset', [None] * len(entries))):
+            if ifd_offset is None:
+                # index tables written before the offsets were stored
+                page = tiff.pages[int(page_nr)]
+            else:
+                tiff.filehandle.seek(int(ifd_offset))
+                page = tifffile.TiffPage(tiff, index=int(page_nr))
+            crop = page.asarray()
+            if crop.ndim == 2:
+                crop = crop[np.newaxis]
+            crops.append(crop)
+    return crops
+
+
+def load_object_crop(fn, label, index=None):
+    """
+    Loads a single object crop saved by save_object_stack_bulk
+    :param fn: the tiff filename
+    :param label: the object label
+    :param index: optional, the index table, read from fn + '.index.csv' if not provided
+    :return: the crop, CXY
+    """
+    return load_object_crops(fn, [label], index=index)[0]
+
+
 ## for processing cellprofiler output
 def name_from_metal(metal, namedict, sep=None):
     """
@@ -601,7 +1967,121 @@ def metal_from_name(name, sep=None):
     return name.split(sep)[-1]
 
 
-def add_masks_to_imgdata(dat_image, mask_fncol, base_folder, re_meta):
+class LRUCache(object):
+    """
+    A bounded dict like cache, dropping the least recently used entries
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class LazyMask(NDArrayOperatorsMixin):
+    """
+    A handle to a mask tiff file, which is only read on demand.
+
+    Behaves like an array for numpy functions and operators. Loaded masks are kept in a
+    bounded LRU cache, memory mapped where the file layout allows.
+    When pickled, e.g. for worker processes, only the file handle is transferred.
+    """
+
+    def __init__(self, fn, shape, dtype, cache=None):
+        self.fn = fn
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if cache is None:
+            cache = LRUCache(1)
+        self.cache = cache
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def load(self):
+        """
+        :return: the mask array
+        """
+        mask = self.cache.get(self.fn)
+        if mask is None:
+            try:
+                mask = tifffile.memmap(self.fn, mode='r')
+            except ValueError:
+                mask = tif.imread(self.fn)
+            self.cache[self.fn] = mask
+        return mask
+
+    def __array__(self, dtype=None, copy=None):
+        mask = np.asarray(self.load())
+        if dtype is not None:
+            mask = mask.astype(dtype, copy=False)
+        return mask
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [x.load() if isinstance(x, LazyMask) else x for x in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __getitem__(self, item):
+        return self.load()[item]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = LRUCache(1)
+
+    def __repr__(self):
+        return 'LazyMask(' + repr(self.fn) + ', shape=' + repr(self.shape) + ')'
+
+
+def _read_tiff_header(fn):
+    """
+    Reads shape and dtype of a tiff file without reading the image data
+    :param fn: the filename
+    :return: shape, dtype
+    """
+    with tifffile.TiffFile(fn) as tiff:
+        series = tiff.series[0]
+        return series.shape, series.dtype
+
+
+def add_masks_to_imgdata(dat_image, mask_fncol, base_folder, re_meta, lazy=False, cache_size=32, n_jobs=8):
     """
     adds the mask data to the image data
     :param dat_image: a pandas frame from the loaded cellprofiler metadata
@@ -612,12 +2092,25 @@ def add_masks_to_imgdata(dat_image, mask_fncol, base_folder, re_meta):
             optional fields are:
                 x, y: position of the topleft corner of the acquisition site
                 cutid: id of the cut=the subregion of the current site
+    :param lazy: if True, only the tiff headers are read and the 'mask' column
+            contains LazyMask handles loading the masks on demand
+    :param cache_size: number of masks kept loaded in lazy mode
+    :param n_jobs: number of threads reading the tiff headers in lazy mode
 
     :return: dat_image: the modified dat_image
     """
 
-    dat_image['mask'] = dat_image[mask_fncol].map(
-        lambda fn: tif.imread(os.path.join(base_folder, fn)))
+    if lazy:
+        fns = [os.path.join(base_folder, fn) for fn in dat_image[mask_fncol]]
+        cache = LRUCache(cache_size)
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            headers = list(pool.map(_read_tiff_header, fns))
+        masks = np.empty(len(fns), dtype=object)
+        masks[:] = [LazyMask(fn, shape, dtype, cache=cache) for fn, (shape, dtype) in zip(fns, headers)]
+        dat_image['mask'] = pd.Series(masks, index=dat_image.index)
+    else:
+        dat_image['mask'] = dat_image[mask_fncol].map(
+            lambda fn: tif.imread(os.path.join(base_folder, fn)))
 
     groupdicts = dat_image[mask_fncol].map(lambda x: re_meta.search(x).groupdict())
     if ('x' in groupdicts[0]) & ('y' in groupdicts[0]):
@@ -661,9 +2154,7 @@ def aggregate_nb_data(cell_dat, nb_dict, fil=None, agg_fkt=np.mean, out_array=No
     if out_array is not None:
         nb_dat = out_array
     else:
-        out_dat = cell_dat.copy()
-        out_dat.loc[:] = np.nan
-        nb_dat = out_dat.values
+        nb_dat = np.full(cell_dat.shape, np.nan)
 
     id_dict = {cellid: int(idx) for idx, cellid in enumerate(cell_dat.index) if cellid not in fil_idx}
     dat_idx = id_dict.keys()
@@ -671,28 +2162,42 @@ def aggregate_nb_data(cell_dat, nb_dict, fil=None, agg_fkt=np.mean, out_array=No
     for cid, nids in nb_dict.items():
         if (nids != []) & (cid in dat_idx) & all(i in dat_idx for i in nids):
             nidxs = np.array([id_dict[i] for i in nids if i != cid])
-            if nidxs != []:
+            if len(nidxs) > 0:
                 nb_dat[id_dict[cid], :] = np.apply_along_axis(agg_fkt, 0, cell_dat.values[nidxs, :])
 
     if out_array is not None:
         return True
     else:
-        return out_dat
+        return pd.DataFrame(nb_dat, index=cell_dat.index, columns=cell_dat.columns)
+
+
+# numpy reductions that are calculated by aggregate_nb_data_sparse
+NB_AGG_FKTS = {np.mean: 'mean', np.sum: 'sum', np.max: 'max', np.amax: 'max', np.min: 'min', np.amin: 'min'}
 
 
 def aggregate_nb_data_imgs(cell_dat_img, nb_dicts, value_col='cell_int_mean', agg_fkt=np.mean, fil_col=None,
                            out_value_col='cell_nb_mean', imgid_level='cut_id', cellid_level='cell_id'):
     """
     Aggregates data based on neighbouhood dicts
+
+    If agg_fkt is a statistic name ('mean', 'sum', 'count', 'max', 'min') or one of np.mean, np.sum,
+    np.max and np.min the vectorized aggregate_nb_data_sparse is used.
     """
 
+    agg_fkt = NB_AGG_FKTS.get(agg_fkt, agg_fkt)
+    if isinstance(agg_fkt, str):
+        return aggregate_nb_data_sparse(cell_dat_img, nb_dicts=nb_dicts, value_col=value_col, stats=[agg_fkt],
+                                        fil_col=fil_col, out_value_cols={agg_fkt: out_value_col},
+                                        imgid_level=imgid_level, cellid_level=cellid_level)
+
     assert (len(cell_dat_img.index.names) == 2)
 
     if cell_dat_img.index.names[0] != imgid_level:
         cell_dat_img = cell_dat_img.swaplevel(0, 1, axis=0)
 
-    out_dats = cell_dat_img[value_col].copy()
-    out_dats.loc[:] = np.nan
+    out_dats = cell_dat_img[value_col]
+    out_vals = np.full(out_dats.shape, np.nan)
+    img_index = cell_dat_img.index.get_level_values(imgid_level)
 
     for imgid in nb_dicts.index.get_level_values(imgid_level).unique():
 
@@ -709,23 +2214,293 @@ def aggregate_nb_data_imgs(cell_dat_img, nb_dicts, value_col='cell_int_mean', ag
             fil = None
 
         in_cell_dat = cell_dat.loc[:, value_col]
+        img_pos = np.flatnonzero(img_index == imgid)
+        img_vals = out_vals[img_pos]
         aggregate_nb_data(cell_dat=in_cell_dat, nb_dict=nb_dict, fil=fil, agg_fkt=agg_fkt,
-                          out_array=out_dats.loc[imgid].values)
+                          out_array=img_vals)
+        out_vals[img_pos] = img_vals
 
+    out_dats = pd.DataFrame(out_vals, index=out_dats.index, columns=out_dats.columns)
     out_dats = pd.concat({out_value_col: out_dats}, axis=1, names=cell_dat_img.columns.names)
     return out_dats
 
 
+NB_STATS = ('mean', 'sum', 'count', 'max', 'min')
+
+
+def nb_dicts_to_adjacency(nb_dicts, index, imgid_level='cut_id', cellid_level='cell_id', return_unknown=False):
+    """
+    Converts per image neighbourhoods into a single sparse adjacency matrix aligned
+    with the rows of a cell table.
+
+    Neighbours that are not contained in the index and self neighbourhoods are ignored.
+    Use return_unknown to get the cells with such neighbours, e.g. to pass them to aggregate_nb_adjacency.
+
+    :param nb_dicts: a pandas series with the image id as (first) index level and as values either
+        neighbourhood dicts (key=label, entry=neighbour labels) or (labels, adjacency) tuples
+        as returned by make_neighbourhood_graph(output='sparse')
+    :param index: the (image id, cell id) multiindex of the cell table
+    :param imgid_level: the name of the image id level
+    :param cellid_level: the name of the cell id level
+    :param return_unknown: if True, additionally return a boolean array of shape (len(index),)
+        that is True for cells with neighbours not contained in the index
+    :return: a scipy.sparse CSR matrix of shape (len(index), len(index)) with 1 for neighbours
+        (and the unknown neighbour array if return_unknown)
+    """
+    imgids, firsts, seconds = list(), list(), list()
+    for key, nb in nb_dicts.items():
+        if len(nb_dicts.index.names) > 1:
+            key = key[nb_dicts.index.names.index(imgid_level)]
+
+        if isinstance(nb, dict):
+            first = np.repeat(np.array(list(nb.keys())), [len(nids) for nids in nb.values()])
+            second = np.array([i for nids in nb.values() for i in nids])
+        else:
+            labels, adj = nb
+            adj = adj.tocoo()
+            first, second = np.asarray(labels)[adj.row], np.asarray(labels)[adj.col]
+
+        imgids.append(np.repeat(key, len(first)))
+        firsts.append(first)
+        seconds.append(second)
+
+    if len(firsts) == 0:
+        adj = sparse.csr_matrix((len(index), len(index)))
+        if return_unknown:
+            return adj, np.zeros(len(index), dtype=bool)
+        return adj
+
+    imgids, firsts, seconds = np.concatenate(imgids), np.concatenate(firsts), np.concatenate(seconds)
+    is_nb = firsts != seconds
+    imgids, firsts, seconds = imgids[is_nb], firsts[is_nb], seconds[is_nb]
+
+    def get_pos(cellids):
+        levels = {imgid_level: imgids, cellid_level: cellids}
+        return index.get_indexer(pd.MultiIndex.from_arrays([levels[n] for n in index.names]))
+
+    rows, cols = get_pos(firsts), get_pos(seconds)
+    is_known = (rows >= 0) & (cols >= 0)
+    adj = sparse.coo_matrix((np.ones(is_known.sum()), (rows[is_known], cols[is_known])),
+                            shape=(len(index), len(index))).tocsr()
+    adj.sum_duplicates()
+    adj.data[:] = 1
+    if return_unknown:
+        unknown = np.zeros(len(index), dtype=bool)
+        unknown[rows[(rows >= 0) & (cols < 0)]] = True
+        return adj, unknown
+    return adj
+
+
+def aggregate_nb_adjacency(values, adj, stats=('mean',), valid=None, unknown=None):
+    """
+    Aggregates values over neighbourhoods given as sparse adjacency matrix.
+
+    mean, sum and count are calculated via sparse matrix products, max and min via
+    segment reductions over the neighbours of each cell.
+    Cells without neighbours, filtered cells, cells with filtered neighbours and cells
+    with unknown neighbours get NaN, as in aggregate_nb_data.
+
+    :param values: array of shape (ncells, nvalues) or (ncells,)
+    :param adj: sparse adjacency matrix of shape (ncells, ncells), e.g. from nb_dicts_to_adjacency
+    :param stats: list of statistic names: 'mean', 'sum', 'count', 'max', 'min'
+    :param valid: optional, boolean array of shape (ncells,), cells to use
+    :param unknown: optional, boolean array of shape (ncells,), cells with neighbours missing from adj,
+        e.g. from nb_dicts_to_adjacency(return_unknown=True)
+    :return: a dict with key=statistic name and entry=array shaped as values
+    """
+    for stat in stats:
+        if stat not in NB_STATS:
+            raise NameError('Invalid neighbourhood statistic: ' + str(stat) + ', use one of ' + ', '.join(NB_STATS))
+
+    values = np.asarray(values, dtype=np.float64)
+    adj = sparse.csr_matrix(adj)
+    adj.sum_duplicates()
+    counts = np.diff(adj.indptr)
+
+    no_agg = counts == 0
+    if valid is not None:
+        valid = np.asarray(valid, dtype=bool)
+        no_agg |= ~valid
+        no_agg |= (adj @ (~valid).astype(np.float64)) > 0
+    if unknown is not None:
+        no_agg |= np.asarray(unknown, dtype=bool)
+
+    out_dict = dict()
+    for stat in stats:
+        if stat == 'count':
+            out = np.broadcast_to(np.reshape(counts, (-1,) + (1,) * (values.ndim - 1)), values.shape)
+            out = out.astype(np.float64)
+        elif stat in ('mean', 'sum'):
+            if stat == 'mean':
+                norm = np.zeros(len(counts))
+                norm[counts > 0] = 1 / counts[counts > 0]
+                nb_adj = sparse.diags(norm) @ adj
+            else:
+                nb_adj = adj
+            out = np.asarray(nb_adj @ values, dtype=np.float64)
+        else:
+            reduce_fkt = np.maximum if stat == 'max' else np.minimum
+            out = np.empty(values.shape)
+            has_nb = counts > 0
+            if np.any(has_nb):
+                out[has_nb] = reduce_fkt.reduceat(values[adj.indices], adj.indptr[:-1][has_nb], axis=0)
+        out[no_agg] = np.nan
+        out_dict[stat] = out
+    return out_dict
+
+
+def aggregate_nb_data_sparse(cell_dat_img, nb_dicts=None, adjacency=None, value_col='cell_int_mean',
+                             stats=('mean',), fil_col=None, out_value_cols=None, imgid_level='cut_id',
+                             cellid_level='cell_id', unknown=None):
+    """
+    Vectorized version of aggregate_nb_data_imgs, aggregating all images in one call.
+
+    :param cell_dat_img: cell data with an (image id, cell id) index
+    :param nb_dicts: a pandas series of neighbourhoods per image, see nb_dicts_to_adjacency
+    :param adjacency: alternatively to nb_dicts, a sparse adjacency matrix aligned with the rows
+        of cell_dat_img
+    :param value_col: the column to aggregate
+    :param stats: list of statistic names: 'mean', 'sum', 'count', 'max', 'min'
+    :param fil_col: optional, a boolean column. Only cells with True are used.
+    :param out_value_cols: optional, dict with key=statistic and entry=output column name,
+        defaults to 'cell_nb_<statistic>'
+    :param imgid_level: the name of the image id level
+    :param cellid_level: the name of the cell id level
+    :param unknown: optional, with adjacency: boolean array of shape (len(cell_dat_img),), cells with
+        neighbours not contained in cell_dat_img. These get NaN.
+    :return: the aggregated data
+    """
+    assert (len(cell_dat_img.index.names) == 2)
+
+    if cell_dat_img.index.names[0] != imgid_level:
+        cell_dat_img = cell_dat_img.swaplevel(0, 1, axis=0)
+
+    if adjacency is None:
+        adjacency, unknown = nb_dicts_to_adjacency(nb_dicts, cell_dat_img.index, imgid_level=imgid_level,
+                                                   cellid_level=cellid_level, return_unknown=True)
+
+    if fil_col is not None:
+        valid = (cell_dat_img.loc[:, fil_col] == True).values
+    else:
+        valid = None
+
+    if out_value_cols is None:
+        out_value_cols = dict()
+
+    in_dat = cell_dat_img[value_col]
+    agg_dict = aggregate_nb_adjacency(in_dat.values, adjacency, stats=stats, valid=valid, unknown=unknown)
+
+    out_dats = dict()
+    for stat in stats:
+        out_dat = in_dat.copy()
+        out_dat.loc[:] = agg_dict[stat]
+        out_dats[out_value_cols.get(stat, 'cell_nb_' + stat)] = out_dat
+
+    out_dats = pd.concat(out_dats, axis=1, names=cell_dat_img.columns.names)
+    return out_dats
+
+
+def relationships_to_adjacency(relationships, index=None, imgid_col='ImageNumber_First',
+                               first_col='ObjectNumber_First', second_col='ObjectNumber_Second',
+                               output='matrix', imgid_level='cut_id', cellid_level='cell_id', return_unknown=False):
+    """
+    Converts a multi image relationship table (e.g. the CellProfiler object relationships
+    export) into sparse adjacency in one vectorized pass, without building neighbourhood dicts.
+
+    Self relationships and duplicates are ignored.
+
+    :param relationships: table with an image id, a first and a second object column
+    :param index: optional, the (image id, cell id) multiindex of a cell table. If given
+        the adjacency is aligned with its rows and relationships of objects not contained are dropped,
+        e.g. for aggregate_nb_data_sparse(adjacency=...). See return_unknown to mark the affected objects.
+    :param imgid_col: the image id column
+    :param first_col: the first object column
+    :param second_col: the second object column
+    :param output: 'matrix' or 'series'
+    :param imgid_level: the name of the image id level
+    :param cellid_level: the name of the cell id level
+    :param return_unknown: output 'matrix' only. If True, additionally return a boolean array aligned with
+        the rows of the adjacency that is True for objects with relationships to objects not contained
+        in the index, e.g. for aggregate_nb_data_sparse(unknown=...).
+    :return: output 'matrix' with index: a CSR matrix of shape (len(index), len(index)).
+        output 'matrix' without index: (vertices, adjacency, offsets): the (image id, cell id)
+            multiindex of all objects sorted by image, the block diagonal CSR matrix and a series
+            with the first row of every image.
+        output 'series': a series with key=image id and entry=(labels, CSR adjacency) per image,
+            usable as nb_dicts for nb_dicts_to_adjacency.
+        With return_unknown a tuple of the above and the unknown neighbour array.
+    """
+    if output not in ('matrix', 'series'):
+        raise NameError('Invalid output: ' + str(output) + ', use matrix or series')
+    if return_unknown and (output != 'matrix'):
+        raise NameError('return_unknown is only supported for output matrix')
+
+    imgids = relationships[imgid_col].values
+    firsts = relationships[first_col].values
+    seconds = relationships[second_col].values
+    is_nb = firsts != seconds
+    imgids, firsts, seconds = imgids[is_nb], firsts[is_nb], seconds[is_nb]
+
+    if (index is None) or (output == 'series'):
+        vertices = pd.MultiIndex.from_arrays([np.concatenate([imgids, imgids]),
+                                              np.concatenate([firsts, seconds])],
+                                             names=[imgid_level, cellid_level]).unique().sort_values()
+        if index is not None:
+            vertices = vertices[index.reorder_levels(vertices.names).get_indexer(vertices) >= 0]
+    else:
+        vertices = index
+
+    def get_pos(cellids):
+        levels = {imgid_level: imgids, cellid_level: cellids}
+        return vertices.get_indexer(pd.MultiIndex.from_arrays([levels[n] for n in vertices.names]))
+
+    rows, cols = get_pos(firsts), get_pos(seconds)
+    is_known = (rows >= 0) & (cols >= 0)
+    adj = sparse.coo_matrix((np.ones(is_known.sum()), (rows[is_known], cols[is_known])),
+                            shape=(len(vertices), len(vertices))).tocsr()
+    adj.sum_duplicates()
+    adj.data[:] = 1
+    unknown = np.zeros(len(vertices), dtype=bool)
+    unknown[rows[(rows >= 0) & (cols < 0)]] = True
+
+    if (output == 'matrix') and (index is not None):
+        if return_unknown:
+            return adj, unknown
+        return adj
+
+    img_vals = vertices.get_level_values(imgid_level)
+    is_first = np.ones(len(vertices), dtype=bool)
+    is_first[1:] = img_vals[1:] != img_vals[:-1]
+    starts = np.flatnonzero(is_first)
+    offsets = pd.Series(starts, index=pd.Index(img_vals[starts], name=imgid_level))
+    if output == 'matrix':
+        if return_unknown:
+            return vertices, adj, offsets, unknown
+        return vertices, adj, offsets
+
+    cellids = vertices.get_level_values(cellid_level).values
+    ends = np.append(starts[1:], len(vertices))
+    return pd.Series([(cellids[start:end], adj[start:end, start:end]) for start, end in zip(starts, ends)],
+                     index=offsets.index)
+
+
 def get_nb_dict(coldat):
     """
     Converts relationship lists to dict
+    :param coldat: table with the first object in the first and the second object in the second column
+    :return: dict with key=first object and entry=set of second objects
     """
-    first_obj = coldat.iloc[:, 0]
-    second_obj = coldat.iloc[:, 1]
+    first_obj = coldat.iloc[:, 0].values
+    second_obj = coldat.iloc[:, 1].values
 
-    nb_dict = dict((obj, set()) for obj in np.unique(first_obj))
+    order = np.argsort(first_obj, kind='stable')
+    objs, starts = np.unique(first_obj[order], return_index=True)
+    second_obj = second_obj[order]
 
-    for f, s in zip(first_obj, second_obj):
-        nb_dict[f].add(s)
+    nb_dict = dict(zip(objs.tolist(), (set(s.tolist()) for s in np.split(second_obj, starts[1:]))))
 
     return nb_dict
+
+
+# record the public functions while pycytools.profiling is enabled
+profiling.instrument_module(globals())
@@ -1,66 +1,202 @@
-import matplotlib.pyplot as plt
+import weakref
+
 import numpy as np
-from scipy.ndimage.filters import gaussian_filter
 
 import pycytools.library as lib
+from pycytools._lazy import lazy_import
+
+# heavy dependencies are only imported on first use
+plt = lazy_import('matplotlib.pyplot')
+ndi = lazy_import('scipy.ndimage')
+
+RGB_COLORS = [(1, 0, 0), (0, 1, 0), (0, 0, 1)]
+SEVEN_COLORS = [(1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 1), (0, 1, 1), (1, 0, 1), (1, 1, 0)]
+
+
+def _evict_image(cache, img_id):
+    for key in cache.keys():
+        if key[0] == img_id:
+            cache.pop(key)
+
+
+class ImcCompositor(object):
+    """
+    Blends preprocessed imc channels into rgb images.
+
+    The preprocessed channels (outlier removal, gaussian blur, percentile scaling)
+    are cached per (image, metal, parameters) in a bounded cache, such that browsing
+    many channel combinations of an image only preprocesses every channel once.
+    Only weak references to the images are kept, the channels of an image are evicted
+    when it is garbage collected.
+    """
+
+    def __init__(self, norm_perc=99.9, sigma=1, outlierthresh=30, cache_size=32):
+        """
+        :param norm_perc: default percentile scaled to 1
+        :param sigma: default sigma of the gaussian blur, in pixels of the full resolution
+        :param outlierthresh: default threshold for the outlier removal
+        :param cache_size: number of preprocessed channels to keep
+        """
+        self.norm_perc = norm_perc
+        self.sigma = sigma
+        self.outlierthresh = outlierthresh
+        self._cache = lib.LRUCache(cache_size)
+        self._tracked = weakref.WeakValueDictionary()
+
+    def get_channel(self, imc_img, metal, norm_perc=None, sigma=None, outlierthresh=None, downsample=1, cap=None):
+        """
+        Returns the preprocessed channel of a metal, scaled to [0, 1]
+        :param imc_img: the imc image, providing get_img_by_metal
+        :param metal: the metal
+        :param downsample: integer factor to downsample the channel by block averaging, for previews
+        :param cap: optional, a precomputed intensity scaled to 1 instead of the norm_perc percentile
+            of the channel, e.g. cohort wide from library.ChannelPercentiles
+        :return: float32 image
+        """
+        norm_perc = self.norm_perc if norm_perc is None else norm_perc
+        sigma = self.sigma if sigma is None else sigma
+        outlierthresh = self.outlierthresh if outlierthresh is None else outlierthresh
+        if cap is not None:
+            cap = float(cap)
+            norm_perc = None
+
+        key = (id(imc_img), metal, norm_perc, cap, sigma, outlierthresh, downsample)
+        cached = self._cache.get(key)
+        if (cached is not None) and (cached[0]() is imc_img):
+            return cached[1]
+
+        img = np.asarray(imc_img.get_img_by_metal(metal)).astype(np.uint16)
+        img = lib.remove_outlier_pixels(img, threshold=outlierthresh)
+        if downsample > 1:
+            h, w = img.shape[0] // downsample, img.shape[1] // downsample
+            img = img[:(h * downsample), :(w * downsample)].reshape(h, downsample, w, downsample)
+            img = img.mean(axis=(1, 3), dtype=np.float32)
+        else:
+            img = img.astype(np.float32)
+        ndi.gaussian_filter(img, sigma=sigma / downsample, output=img)
+        if cap is None:
+            cap = np.percentile(img, norm_perc)
+        if cap > 0:
+            img /= cap
+        np.minimum(img, 1, out=img)
 
+        try:
+            img_ref = weakref.ref(imc_img)
+        except TypeError:
+            # images without weak reference support are not cached
+            return img
+        if self._tracked.get(id(imc_img)) is not imc_img:
+            # evict the channels before the id of the image can be reused
+            weakref.finalize(imc_img, _evict_image, self._cache, id(imc_img))
+            self._tracked[id(imc_img)] = imc_img
+        self._cache[key] = (img_ref, img)
+        return img
 
-def plot_rgb_imc(imc_img, metals, norm_perc=99.9, sigma=1, outlierthresh=30, saturation=1):
+    def render(self, imc_img, metals, colors, alphas=None, saturation=1, downsample=1, out=None,
+               dtype=np.float32, caps=None, **kwargs):
+        """
+        Blends channels into a rgb image
+        :param imc_img: the imc image, providing get_img_by_metal
+        :param metals: list of metals
+        :param colors: list of rgb tuples, one per metal
+        :param alphas: optional, list of weights, one per metal
+        :param saturation: factor applied to the blended image
+        :param downsample: integer factor to render a downsampled preview
+        :param out: optional, float32 buffer of shape (h, w, 3) to blend into
+        :param dtype: np.float32 for an image in [0, 1], np.uint8 for [0, 255]
+        :param caps: optional, list of precomputed caps, one per metal, see get_channel.
+            None entries use the percentile.
+        :param kwargs: preprocessing parameters, see get_channel
+        :return: the rgb image
+        """
+        if alphas is None:
+            alphas = np.ones(len(metals))
+        if caps is None:
+            caps = [None] * len(metals)
+
+        for i, (metal, col, alpha, cap) in enumerate(zip(metals, colors, alphas, caps)):
+            img = self.get_channel(imc_img, metal, downsample=downsample, cap=cap, **kwargs)
+            if out is None:
+                out = np.zeros(img.shape + (3,), dtype=np.float32)
+            elif i == 0:
+                out[:] = 0
+            if i == 0:
+                tmp = np.empty(img.shape, dtype=np.float32)
+            for k, c in enumerate(col):
+                if c != 0:
+                    np.multiply(img, c * alpha * saturation, out=tmp)
+                    out[..., k] += tmp
+
+        np.minimum(out, 1, out=out)
+        if np.dtype(dtype) == np.uint8:
+            out *= 255
+            return out.astype(np.uint8)
+        return out
+
+
+_default_compositor = ImcCompositor()
+
+
+def get_default_compositor():
+    """
+    :return: the ImcCompositor used by the plotting functions
+    """
+    return _default_compositor
+
+
+def plot_rgb_imc(imc_img, metals, norm_perc=99.9, sigma=1, outlierthresh=30, saturation=1, compositor=None,
+                 caps=None):
     plt.figure()
-    imgstack = [imc_img.get_img_by_metal(m) for m in metals]
-    imgstack = _preproc_img_stack(imgstack, norm_perc, sigma, outlierthresh)
-    pimg = np.stack(imgstack, axis=2)
-    pimg = pimg * saturation
-    pimg[pimg > 1] = 1
+    if compositor is None:
+        compositor = _default_compositor
+    pimg = compositor.render(imc_img, metals, RGB_COLORS, saturation=saturation, norm_perc=norm_perc, sigma=sigma,
+                             outlierthresh=outlierthresh, caps=caps)
     plt.imshow(pimg, interpolation='nearest')
     plt.axis('off')
 
 
-def plot_rgbw_imc(imc_img, metals, w_metal, white_weight=0.4, norm_perc=99.9, sigma=1, outlierthresh=30):
+def plot_rgbw_imc(imc_img, metals, w_metal, white_weight=0.4, norm_perc=99.9, sigma=1, outlierthresh=30,
+                  compositor=None, caps=None):
     plt.figure()
-    imgstack = [imc_img.get_img_by_metal(m) for m in metals + [w_metal]]
-    imgstack = _preproc_img_stack(imgstack, norm_perc, sigma, outlierthresh)
-    pimg = np.stack(imgstack[:3], axis=2) + np.repeat(np.expand_dims(imgstack[3], 2) * white_weight, 3, 2)
-    pimg[pimg > 1] = 1
+    if compositor is None:
+        compositor = _default_compositor
+    pimg = compositor.render(imc_img, list(metals) + [w_metal], RGB_COLORS + [(1, 1, 1)],
+                             alphas=[1, 1, 1, white_weight], norm_perc=norm_perc, sigma=sigma,
+                             outlierthresh=outlierthresh, caps=caps)
     plt.imshow(pimg, interpolation='nearest')
     plt.axis('off')
 
 
-def _preproc_img_stack(imgstack, norm_perc=99.9, sigma=1, outlierthresh=30):
-    imgstack = [lib.remove_outlier_pixels(im.astype(np.uint16), threshold=outlierthresh) for im in imgstack]
-    imgstack = [gaussian_filter(im, sigma=sigma) for im in imgstack]
-    imgstack = [im.astype(np.float) / np.percentile(im, norm_perc) for im in imgstack]
-    for im in imgstack:
-        im[im > 1] = 1
-    return imgstack
-
-
-def get_7_color_img(imc_img, metals, norm_perc=99.9, alphas=None, sigma=1, outlierthresh=30, saturation=1):
+def get_7_color_img(imc_img, metals, norm_perc=99.9, alphas=None, sigma=1, outlierthresh=30, saturation=1,
+                    compositor=None, downsample=1, caps=None):
     """
     Color.red,Color.green,Color.blue,
     Color.white,Color.cyan,Color.magenta,Color.yellow
+
+    caps: optional, precomputed caps, one per metal, see ImcCompositor.get_channel
     """
-    cols = [(1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 1), (0, 1, 1), (1, 0, 1), (1, 1, 0)]
-    imgstack = [imc_img.get_img_by_metal(m) for m in metals if m != 0]
-    curcols = [c for m, c in zip(metals, cols) if m != 0]
-    imgstack = _preproc_img_stack(imgstack, norm_perc, sigma, outlierthresh)
+    if compositor is None:
+        compositor = _default_compositor
+    curmetals = [m for m in metals if m != 0]
+    curcols = [c for m, c in zip(metals, SEVEN_COLORS) if m != 0]
 
     if alphas is None:
-        alphas = np.repeat(1 / len(imgstack), len(imgstack))
+        alphas = np.repeat(1 / len(curmetals), len(curmetals))
     else:
         alphas = [a for m, a in zip(metals, alphas) if m != 0]
-    imgstack = [np.stack([im * c * a for c in col], axis=2) for im, col, a in zip(imgstack, curcols, alphas)]
-
-    pimg = np.sum(imgstack, axis=0)
-    pimg = pimg * saturation
-    pimg[pimg > 1] = 1
+    if caps is not None:
+        caps = [c for m, c in zip(metals, caps) if m != 0]
 
+    pimg = compositor.render(imc_img, curmetals, curcols, alphas=alphas, saturation=saturation,
+                             downsample=downsample, norm_perc=norm_perc, sigma=sigma, outlierthresh=outlierthresh,
+                             caps=caps)
     return pimg.squeeze()
 
 
-def plot_7_color_img(imc_img, metals, norm_perc=99.9, alphas=None, sigma=1, outlierthresh=30, saturation=1):
+def plot_7_color_img(imc_img, metals, norm_perc=99.9, alphas=None, sigma=1, outlierthresh=30, saturation=1,
+                     caps=None):
     plt.figure()
-    pimg = get_7_color_img(imc_img, metals, norm_perc, alphas, sigma, outlierthresh, saturation)
+    pimg = get_7_color_img(imc_img, metals, norm_perc, alphas, sigma, outlierthresh, saturation, caps=caps)
     plt.imshow(pimg.squeeze(), interpolation='nearest')
     plt.axis('off')
 
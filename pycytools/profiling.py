@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in instrumentation of the pycytools functions.
+
+When enabled, every instrumented call records its wall time, the sizes of its
+inputs (pixels, labels, channels) and optionally its peak traced memory.
+When disabled, the only cost is a check of a module flag per call.
+
+Usage:
+    from pycytools import profiling
+    profiling.enable(track_memory=True)
+    for img_id in ...:
+        with profiling.stage('image', img_id=img_id):
+            ...
+    profiling.save_json('profile.json')
+
+Memory is tracked with tracemalloc, which is process wide: concurrent threads
+are attributed to all calls running at the same time.
+"""
+
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_enabled = False
+_track_memory = False
+_records = list()
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable(track_memory=False):
+    """
+    Enables the recording
+    :param track_memory: also record peak allocations via tracemalloc, slows down the calls
+    """
+    global _enabled, _track_memory
+    _track_memory = track_memory
+    if track_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _enabled = True
+
+
+def disable():
+    """
+    Disables the recording, the records are kept
+    """
+    global _enabled
+    _enabled = False
+    if _track_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """
+    Removes all records
+    """
+    with _lock:
+        del _records[:]
+
+
+def get_records():
+    """
+    :return: list of dicts, one per recorded call or stage
+    """
+    with _lock:
+        return list(_records)
+
+
+def _get_frames():
+    if not hasattr(_local, 'frames'):
+        _local.frames = list()
+    return _local.frames
+
+
+def _describe(name, value):
+    """
+    Describes the size of an input
+    :return: dict with e.g. shape, pixels, labels, channels or None for other inputs
+    """
+    if isinstance(value, np.ndarray) or (hasattr(value, 'shape') and hasattr(value, 'dtype')):
+        shape = tuple(int(s) for s in value.shape)
+        desc = {'shape': shape}
+        if len(shape) >= 2:
+            desc['pixels'] = shape[0] * shape[1]
+        if len(shape) == 3:
+            desc['channels'] = shape[2]
+        if ('label' in name) and isinstance(value, np.ndarray) and np.issubdtype(value.dtype, np.integer):
+            desc['labels'] = int(value.max(initial=0))
+        return desc
+    if isinstance(value, (list, tuple)) and (len(value) > 0) and all(hasattr(v, 'shape') for v in value):
+        descs = [_describe(name, v) for v in value]
+        desc = {'n': len(value)}
+        for key in ('pixels', 'labels'):
+            if all(key in d for d in descs):
+                desc[key] = sum(d[key] for d in descs)
+        if 'channels' in descs[0]:
+            desc['channels'] = descs[0]['channels']
+        return desc
+    if hasattr(value, 'index') and hasattr(value, 'columns'):
+        return {'rows': int(value.shape[0]), 'columns': int(value.shape[1])}
+    return None
+
+
+def _describe_inputs(fkt, args, kwargs):
+    try:
+        bound = inspect.signature(fkt).bind(*args, **kwargs)
+    except (TypeError, ValueError):
+        return dict()
+    inputs = dict()
+    for name, value in bound.arguments.items():
+        desc = _describe(name, value)
+        if desc is not None:
+            inputs[name] = desc
+    return inputs
+
+
+def _start_frame():
+    frames = _get_frames()
+    frame = {'start': time.perf_counter(), 'peak': 0, 'mem_start': 0}
+    if _track_memory and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        if len(frames) > 0:
+            frames[-1]['peak'] = max(frames[-1]['peak'], peak)
+        frame['mem_start'] = current
+        tracemalloc.reset_peak()
+    frames.append(frame)
+    return frame
+
+
+def _end_frame(frame, record):
+    frames = _get_frames()
+    frames.pop()
+    record['time'] = time.perf_counter() - frame['start']
+    if _track_memory and tracemalloc.is_tracing():
+        peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+        record['peak_mb'] = (peak - frame['mem_start']) / 2 ** 20
+        if len(frames) > 0:
+            frames[-1]['peak'] = max(frames[-1]['peak'], peak)
+    record['stages'] = [s for s in getattr(_local, 'stages', [])]
+    with _lock:
+        _records.append(record)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps(record, default=str))
+
+
+def instrument(fkt):
+    """
+    Decorator recording the calls of a function while the profiling is enabled
+    """
+
+    @functools.wraps(fkt)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return fkt(*args, **kwargs)
+
+        record = OrderedDict([('name', fkt.__module__ + '.' + fkt.__name__),
+                              ('inputs', _describe_inputs(fkt, args, kwargs))])
+        frame = _start_frame()
+        try:
+            return fkt(*args, **kwargs)
+        finally:
+            _end_frame(frame, record)
+
+    return wrapper
+
+
+def instrument_module(namespace):
+    """
+    Instruments all public functions defined in a module
+    :param namespace: the globals() of the module
+    """
+    module_name = namespace['__name__']
+    for name, obj in list(namespace.items()):
+        if inspect.isfunction(obj) and (obj.__module__ == module_name) and not name.startswith('_'):
+            namespace[name] = instrument(obj)
+
+
+@contextmanager
+def stage(name, **tags):
+    """
+    Context manager recording a pipeline stage, e.g. the processing of one image.
+    Calls within the stage are tagged with its name and tags.
+    :param name: the stage name
+    :param tags: additional json serializable tags, e.g. img_id
+    """
+    if not _enabled:
+        yield
+        return
+
+    if not hasattr(_local, 'stages'):
+        _local.stages = list()
+    record = OrderedDict([('name', 'stage:' + name), ('tags', tags)])
+    frame = _start_frame()
+    _local.stages.append(dict(tags, stage=name))
+    try:
+        yield
+    finally:
+        _local.stages.pop()
+        _end_frame(frame, record)
+
+
+def summary():
+    """
+    Aggregates the records per function/stage
+    :return: dict with key=name and entry=dict of calls, total/mean/max time and max peak memory
+    """
+    out = OrderedDict()
+    for rec in get_records():
+        s = out.setdefault(rec['name'], {'calls': 0, 'total_time': 0., 'max_time': 0.})
+        s['calls'] += 1
+        s['total_time'] += rec['time']
+        s['max_time'] = max(s['max_time'], rec['time'])
+        if 'peak_mb' in rec:
+            s['max_peak_mb'] = max(s.get('max_peak_mb', 0.), rec['peak_mb'])
+    for s in out.values():
+        s['mean_time'] = s['total_time'] / s['calls']
+    return out
+
+
+def save_json(fn):
+    """
+    Saves the records and their summary as json
+    :param fn: the filename
+    """
+    with open(fn, 'w') as f:
+        json.dump({'summary': summary(), 'records': get_records()}, f, indent=1, default=str)
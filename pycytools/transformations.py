@@ -1,5 +1,10 @@
 import numpy as np
 
+from pycytools._lazy import is_instance
+from pycytools._lazy import lazy_import
+
+pd = lazy_import('pandas')
+
 
 def logtransf_data(x, offset=None):
     """
@@ -13,10 +18,21 @@ def logtransf_data(x, offset=None):
     :return: Transformed values
     """
     if offset is None:
-        offset = min(x[x > 0])
+        offset = np.min(x[x > 0])
     return (np.log10(x + offset))
 
 
+def inv_logtransf_data(x, offset):
+    """
+    Inverse of logtransf_data
+
+    :param x: log transformed values
+    :param offset: The offset used for the transformation
+    :return: values
+    """
+    return np.power(10., x) - offset
+
+
 def asinhtransf_data(x, cof=5):
     """
     Asinh transformation accoring to
@@ -27,3 +43,194 @@ def asinhtransf_data(x, cof=5):
     :return: transformed values
     """
     return np.arcsinh(x / cof)
+
+
+def inv_asinhtransf_data(x, cof=5):
+    """
+    Inverse of asinhtransf_data:
+    sinh(x)*cof
+
+    :param x: asinh transformed values
+    :param cof: cofactor
+    :return: values
+    """
+    return np.sinh(x) * cof
+
+
+def _asinh_chunk(x, cof, out):
+    np.divide(x, cof, out=out)
+    np.arcsinh(out, out=out)
+
+
+def _inv_asinh_chunk(x, cof, out):
+    np.sinh(x, out=out)
+    np.multiply(out, cof, out=out)
+
+
+def _log_chunk(x, offset, out):
+    np.add(x, offset, out=out)
+    np.log10(out, out=out)
+
+
+def _inv_log_chunk(x, offset, out):
+    np.power(10., x, out=out)
+    np.subtract(out, offset, out=out)
+
+
+def _get_channel_params(dat, params):
+    """
+    Per channel parameters as array
+    :param dat: DataFrame or 2D array
+    :param params: a scalar, a sequence with one value per channel or for DataFrames a dict/Series by column
+    :return: array with one value per channel
+    """
+    nchannels = dat.shape[1]
+    if isinstance(params, dict) or is_instance(params, 'pandas', 'Series'):
+        params = [params[c] for c in dat.columns]
+    return np.broadcast_to(np.asarray(params, dtype=np.float64), (nchannels,))
+
+
+def _frame_float_values(dat):
+    """
+    The single float ndarray holding the data of a DataFrame, writeable
+    :param dat: DataFrame
+    :return: the (nrows, ncols) array or None, if the frame has several dtypes or
+        shares its data with other frames (copy on write)
+    """
+    if (dat.shape[1] == 0) or (len(set(dat.dtypes)) != 1) or (not np.issubdtype(dat.dtypes.iloc[0], np.floating)):
+        return None
+    values = dat.values
+    if not values.flags.writeable:
+        # with copy on write pandas only hands out read only views of its data
+        blocks = dat._mgr.blocks
+        if (len(blocks) != 1) or blocks[0].refs.has_reference():
+            return None
+        values.flags.writeable = True
+    return values
+
+
+def _transf_table(dat, chunk_fkt, params, inplace, dtype, chunk_size):
+    """
+    Applies a transformation chunk by chunk to a cell x channel table
+    :param dat: DataFrame or 2D array
+    :param chunk_fkt: function of the form chunk_fkt(x, param, out)
+    :param params: per channel parameters, see _get_channel_params
+    :param inplace: if True the table is overwritten. DataFrames without a single float array
+        holding their data are overwritten column by column.
+    :param dtype: the output dtype if not inplace
+    :param chunk_size: number of rows processed at once
+    :return: the transformed table
+    """
+    params = _get_channel_params(dat, params)
+    nrows = dat.shape[0]
+
+    if is_instance(dat, 'pandas', 'DataFrame'):
+        values = _frame_float_values(dat) if inplace else None
+        if values is not None:
+            _transf_table(values, chunk_fkt, params, True, dtype, chunk_size)
+            return dat
+
+        if inplace:
+            for i, col in enumerate(dat.columns):
+                x = dat.iloc[:, i].values
+                out = np.empty(nrows, dtype=x.dtype if np.issubdtype(x.dtype, np.floating) else dtype)
+                for start in range(0, nrows, chunk_size):
+                    sl = np.s_[start:(start + chunk_size)]
+                    chunk_fkt(x[sl], params[i], out[sl])
+                dat.isetitem(i, out)
+            return dat
+
+        # column major, such that the frame wraps the array without consolidating it
+        out = np.empty(dat.shape, dtype=dtype, order='F')
+        for i in range(dat.shape[1]):
+            x = dat.iloc[:, i].values
+            for start in range(0, nrows, chunk_size):
+                sl = np.s_[start:(start + chunk_size)]
+                chunk_fkt(x[sl], params[i], out[sl, i])
+        return pd.DataFrame(out, index=dat.index, columns=dat.columns, copy=False)
+
+    if inplace:
+        if not np.issubdtype(dat.dtype, np.floating):
+            raise TypeError('Only float arrays can be transformed in place')
+        out = dat
+    else:
+        out = np.empty(dat.shape, dtype=dtype)
+    for start in range(0, nrows, chunk_size):
+        sl = np.s_[start:(start + chunk_size)]
+        chunk_fkt(dat[sl], params, out[sl])
+    return out
+
+
+def asinhtransf_table(dat, cofactors=5, inplace=False, dtype=np.float32, chunk_size=2 ** 20):
+    """
+    Asinh transformation of a cell x channel table, processed in chunks
+
+    :param dat: DataFrame or 2D array with channels as columns
+    :param cofactors: a cofactor for all channels, one per channel or a dict by column
+    :param inplace: transform the table in place. Arrays need to be float.
+    :param dtype: the output dtype if not in place
+    :param chunk_size: number of rows processed at once
+    :return: transformed table
+    """
+    return _transf_table(dat, _asinh_chunk, cofactors, inplace, dtype, chunk_size)
+
+
+def inv_asinhtransf_table(dat, cofactors=5, inplace=False, dtype=np.float32, chunk_size=2 ** 20):
+    """
+    Inverse of asinhtransf_table
+
+    :param dat: DataFrame or 2D array with channels as columns
+    :param cofactors: the cofactors used for the transformation
+    :param inplace: transform the table in place. Arrays need to be float.
+    :param dtype: the output dtype if not in place
+    :param chunk_size: number of rows processed at once
+    :return: values
+    """
+    return _transf_table(dat, _inv_asinh_chunk, cofactors, inplace, dtype, chunk_size)
+
+
+def get_log_offsets(dat, chunk_size=2 ** 20):
+    """
+    The minimal non zero value of every channel, the default offsets of logtransf_table
+
+    :param dat: DataFrame or 2D array with channels as columns
+    :param chunk_size: number of rows processed at once
+    :return: array with one offset per channel
+    """
+    values = dat.values if is_instance(dat, 'pandas', 'DataFrame') else dat
+    offsets = np.full(dat.shape[1], np.inf)
+    for start in range(0, dat.shape[0], chunk_size):
+        x = np.asarray(values[start:(start + chunk_size)], dtype=np.float64)
+        np.minimum(offsets, np.where(x > 0, x, np.inf).min(axis=0), out=offsets)
+    return offsets
+
+
+def logtransf_table(dat, offsets=None, inplace=False, dtype=np.float32, chunk_size=2 ** 20):
+    """
+    Log transformation of a cell x channel table, processed in chunks
+
+    :param dat: DataFrame or 2D array with channels as columns
+    :param offsets: an offset for all channels, one per channel or a dict by column.
+        Defaults to the minimal non zero value per channel.
+    :param inplace: transform the table in place. Arrays need to be float.
+    :param dtype: the output dtype if not in place
+    :param chunk_size: number of rows processed at once
+    :return: transformed table
+    """
+    if offsets is None:
+        offsets = get_log_offsets(dat, chunk_size=chunk_size)
+    return _transf_table(dat, _log_chunk, offsets, inplace, dtype, chunk_size)
+
+
+def inv_logtransf_table(dat, offsets, inplace=False, dtype=np.float32, chunk_size=2 ** 20):
+    """
+    Inverse of logtransf_table
+
+    :param dat: DataFrame or 2D array with channels as columns
+    :param offsets: the offsets used for the transformation
+    :param inplace: transform the table in place. Arrays need to be float.
+    :param dtype: the output dtype if not in place
+    :param chunk_size: number of rows processed at once
+    :return: values
+    """
+    return _transf_table(dat, _inv_log_chunk, offsets, inplace, dtype, chunk_size)
@@ -0,0 +1,181 @@
+import re
+
+import numpy as np
+import pandas as pd
+import scipy.ndimage as ndi
+import skimage.morphology
+import tifffile
+
+from pycytools import library as lib
+
+
+def test_lazy_masks_apply_functions_to_list_of_labels(tmp_path):
+    rng = np.random.default_rng(0)
+    masks = [np.zeros((20, 30), dtype=np.uint16) for _ in range(2)]
+    masks[0][2:8, 3:9] = 1
+    masks[0][10:15, 10:20] = 2
+    masks[1][5:12, 5:12] = 3
+    fns = ['site' + str(i) + '_mask.tiff' for i in range(len(masks))]
+    for fn, mask in zip(fns, masks):
+        tifffile.imwrite(str(tmp_path / fn), mask)
+    imgs = [rng.random((20, 30, 2)) for _ in masks]
+
+    dat = pd.DataFrame({'fn': fns})
+    re_meta = re.compile('(?P<site>site[0-9]+)_mask')
+    lazy = lib.add_masks_to_imgdata(dat.copy(), 'fn', str(tmp_path), re_meta, lazy=True)
+    assert isinstance(lazy['mask'][0], lib.LazyMask)
+
+    fkts = ['mean', 'max']
+    exp = lib.apply_functions_to_list_of_labels(masks, imgs, fkts)
+    res = lib.apply_functions_to_list_of_labels(list(lazy['mask']), imgs, fkts)
+    np.testing.assert_array_equal(res, exp)
+    res = lib.apply_functions_to_list_of_labels(list(lazy['mask']), imgs, fkts, n_jobs=2)
+    np.testing.assert_array_equal(res, exp)
+
+    exp = lib.apply_functions_to_list_of_labels_table(masks, imgs, fkts, fkts, ['c0', 'c1'])
+    res = lib.apply_functions_to_list_of_labels_table(list(lazy['mask']), imgs, fkts, fkts, ['c0', 'c1'])
+    pd.testing.assert_frame_equal(res, exp)
+
+
+def test_save_object_stack_bulk_roundtrip(tmp_path):
+    rng = np.random.default_rng(0)
+    labels = np.zeros((40, 50), dtype=np.uint16)
+    labels[2:10, 5:12] = 1
+    labels[20:35, 30:48] = 3
+    slices = ndi.find_objects(labels)
+    for nchannels in (1, 3):
+        stack = rng.integers(0, 1000, (nchannels, 40, 50)).astype(np.uint16)
+        fn = str(tmp_path / ('crops_' + str(nchannels) + '.tiff'))
+        index = lib.save_object_stack_bulk(fn, stack, slices, extent=1)
+        assert list(index['label']) == [1, 3]
+        crops = lib.load_object_crops(fn, [3, 1])
+        for lab, crop in zip([3, 1], crops):
+            sl = lib.extend_slice_touple(slices[lab - 1], 1, labels.shape)
+            np.testing.assert_array_equal(crop, stack[(slice(None),) + tuple(sl)])
+        np.testing.assert_array_equal(lib.load_object_crop(fn, 1, index=index), crops[1])
+
+
+
+def test_remove_outlier_pixels_dtypes():
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 100, (50, 60)).astype(np.uint16)
+    img.flat[rng.integers(0, img.size, 100)] = 1000
+    img[0, :] = rng.integers(0, 1000, 60)
+    for mode in ('median', 'max'):
+        exp = lib.remove_outlier_pixels(img, threshold=50, mode=mode)
+        for dtype in (np.float32, np.float64):
+            res = lib.remove_outlier_pixels(img.astype(dtype), threshold=50, mode=mode)
+            np.testing.assert_array_equal(res, exp.astype(dtype))
+        res = lib.remove_outlier_pixels_stack(np.stack([img, img]).astype(np.float32), threshold=50, mode=mode)
+        np.testing.assert_array_equal(res, np.stack([exp, exp]).astype(np.float32))
+
+
+def make_labels_and_stack(shape=(60, 70), nlabels=40, nchannels=3, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype=np.int32)
+    for lab in rng.permutation(np.arange(1, nlabels + 1)):
+        r, c = rng.integers(0, shape[0] - 5), rng.integers(0, shape[1] - 5)
+        labels[r:(r + rng.integers(2, 12)), c:(c + rng.integers(2, 12))] = lab
+    stack = rng.random(shape + (nchannels,)) * 100
+    return labels, stack
+
+
+def per_object_stats(labels, stack, stat_fkts):
+    objs = np.unique(labels[labels > 0])
+    return objs, np.array([[[fkt(stack[labels == lab, ch]) for fkt in stat_fkts]
+                            for ch in range(stack.shape[2])] for lab in objs])
+
+
+def test_calc_label_stats_tiled():
+    labels, stack = make_labels_and_stack()
+    stat_list = list(lib.TILED_LABEL_STATS)
+    fkts = [len, np.sum, np.mean, np.var, np.std, np.min, np.max]
+    exp_labels, exp = per_object_stats(labels, stack, fkts)
+    for tile_shape in [(7, 9), (16, 16), (100, 100)]:
+        res_labels, res = lib.calc_label_stats_tiled(labels, stack, stat_list, tile_shape=tile_shape)
+        np.testing.assert_array_equal(res_labels, exp_labels)
+        np.testing.assert_allclose(res, exp, rtol=1e-10, atol=1e-8)
+    res_labels, res = lib.calc_label_stats_tiled(labels, np.moveaxis(stack, -1, 0), stat_list, tile_shape=(16, 16),
+                                                 channel_axis=0)
+    np.testing.assert_allclose(res, exp, rtol=1e-10, atol=1e-8)
+
+
+def test_calc_label_stats():
+    labels, stack = make_labels_and_stack()
+    stat_list = ['count', 'sum', 'mean', 'var', 'std', 'min', 'max', 'median', 'q90']
+    fkts = [len, np.sum, np.mean, np.var, np.std, np.min, np.max, np.median, lambda x: np.percentile(x, 90)]
+    exp_labels, exp = per_object_stats(labels, stack, fkts)
+    res_labels, res = lib.calc_label_stats(labels, stack, stat_list)
+    np.testing.assert_array_equal(res_labels, exp_labels)
+    np.testing.assert_allclose(res, exp, rtol=1e-10, atol=1e-8)
+
+    out = lib.apply_functions_to_labels(labels, stack, ['mean', lambda mask, img: np.mean(img[mask])])
+    np.testing.assert_array_equal(out[:, 0], np.repeat(exp_labels, stack.shape[2]))
+    np.testing.assert_allclose(out[:, 1], exp[:, :, 2].ravel())
+    np.testing.assert_allclose(out[:, 2], exp[:, :, 2].ravel())
+
+
+def find_touching_pixels_dilation(label_img, distance=1, selem=None):
+    # the former implementation, dilating label by label
+    if selem is None:
+        selem = skimage.morphology.disk(1)
+    touch_mask = np.zeros(label_img.shape, dtype=bool)
+    not_bg = label_img > 0
+    for i in np.unique(label_img):
+        if i != 0:
+            cur_lab = label_img == i
+            touch_mask[ndi.binary_dilation(cur_lab, structure=selem, iterations=distance, mask=not_bg) &
+                       (cur_lab == False)] = True
+    return touch_mask
+
+
+def test_find_touching_pixels():
+    labels, _ = make_labels_and_stack(nlabels=60)
+    selems = [None, np.ones((3, 3), dtype=bool), np.array([[0, 1, 1], [0, 1, 0], [0, 0, 0]], dtype=bool)]
+    for selem in selems:
+        for distance in (1, 2, 3):
+            exp = find_touching_pixels_dilation(labels, distance=distance, selem=selem)
+            assert exp.any()
+            res = lib.find_touching_pixels(labels, distance=distance, selem=selem)
+            np.testing.assert_array_equal(res, exp)
+
+
+def make_nb_data():
+    rng = np.random.default_rng(0)
+    points = rng.integers(0, 100, (80, 2))
+    rows, cols = np.mgrid[:100, :100]
+    dists = (rows[..., np.newaxis] - points[:, 0]) ** 2 + (cols[..., np.newaxis] - points[:, 1]) ** 2
+    labels = dists.argmin(axis=-1) + 1
+    _, edges = lib.make_neighbourhood_graph(labels, uni_edges=False, output='array')
+    nb_dict = lib.get_nb_dict(pd.DataFrame(edges))
+    nb_dicts = pd.Series({imgid: nb_dict for imgid in (1, 2)})
+    nb_dicts.index.name = 'cut_id'
+
+    # every 7th cell is missing from the table
+    cellids = np.arange(1, 81)
+    cellids = cellids[cellids % 7 != 0]
+    index = pd.MultiIndex.from_product([[1, 2], cellids], names=['cut_id', 'cell_id'])
+    cell_dat = pd.DataFrame(rng.random((len(index), 2)), index=index,
+                            columns=pd.MultiIndex.from_product([['cell_int_mean'], ['c0', 'c1']]))
+    cell_dat[('fil', '')] = rng.random(len(index)) > 0.2
+    return cell_dat, nb_dicts
+
+
+def test_aggregate_nb_data_imgs():
+    cell_dat, nb_dicts = make_nb_data()
+    for fil_col in (None, 'fil'):
+        for agg_fkt in (np.mean, np.sum, np.max, np.min):
+            res = lib.aggregate_nb_data_imgs(cell_dat, nb_dicts, fil_col=fil_col, agg_fkt=agg_fkt)
+            exp = lib.aggregate_nb_data_imgs(cell_dat, nb_dicts, fil_col=fil_col,
+                                             agg_fkt=lambda x, agg_fkt=agg_fkt: agg_fkt(x))
+            assert exp.isna().any().any() and exp.notna().any().any()
+            pd.testing.assert_frame_equal(res, exp)
+
+    relationships = pd.DataFrame([(imgid, cid, nid) for imgid, nb_dict in nb_dicts.items()
+                                  for cid, nids in nb_dict.items() for nid in nids],
+                                 columns=['ImageNumber_First', 'ObjectNumber_First', 'ObjectNumber_Second'])
+    adjacency, unknown = lib.relationships_to_adjacency(relationships, index=cell_dat.index, return_unknown=True)
+    res = lib.aggregate_nb_data_sparse(cell_dat, adjacency=adjacency, unknown=unknown, fil_col='fil',
+                                       stats=['mean'], out_value_cols={'mean': 'cell_nb_mean'})
+    exp = lib.aggregate_nb_data_imgs(cell_dat, nb_dicts, fil_col='fil', agg_fkt=lambda x: np.mean(x))
+    pd.testing.assert_frame_equal(res, exp)
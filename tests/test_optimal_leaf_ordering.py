@@ -0,0 +1,35 @@
+import numpy as np
+from scipy.cluster import hierarchy
+from scipy.spatial import distance
+
+from pycytools.external import optimal_leaf_ordering as olo
+
+
+def all_orderings(node):
+    if node.is_leaf():
+        return [[node.id]]
+    orderings = list()
+    for left in all_orderings(node.get_left()):
+        for right in all_orderings(node.get_right()):
+            orderings += [left + right, right + left]
+    return orderings
+
+
+def ordering_cost(order, dists):
+    return sum(dists[i, j] for i, j in zip(order[:-1], order[1:]))
+
+
+def test_optimal_ordering_exhaustive():
+    rng = np.random.default_rng(0)
+    for nleaves in (2, 3, 5, 8):
+        for method in ('average', 'single', 'complete'):
+            X = rng.random((nleaves, 4))
+            dists = distance.squareform(distance.pdist(X))
+            Z = hierarchy.linkage(X, method=method)
+            order = olo.optimal_ordering(Z, dists)
+
+            orderings = all_orderings(hierarchy.to_tree(Z))
+            assert sorted(order) == list(range(nleaves))
+            assert order in orderings
+            np.testing.assert_allclose(ordering_cost(order, dists),
+                                       min(ordering_cost(o, dists) for o in orderings))
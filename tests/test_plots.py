@@ -0,0 +1,29 @@
+import numpy as np
+
+from pycytools import library as lib
+from pycytools import plots
+
+
+class FakeImcImage(object):
+    def __init__(self, imgs):
+        self.imgs = imgs
+
+    def get_img_by_metal(self, metal):
+        return self.imgs[metal]
+
+
+def test_compositor_caps():
+    rng = np.random.default_rng(0)
+    imc_img = FakeImcImage({m: rng.integers(0, 100, (40, 50)).astype(np.uint16) for m in ['a', 'b', 'c']})
+    compositor = plots.ImcCompositor(sigma=0, outlierthresh=1000)
+
+    caps = lib.ChannelPercentiles.from_stack(np.stack([imc_img.imgs[m] for m in 'abc'])).percentile(50)
+    for metal, cap in zip('abc', caps):
+        exp = np.minimum(imc_img.imgs[metal] / cap, 1)
+        np.testing.assert_allclose(compositor.get_channel(imc_img, metal, cap=cap), exp, rtol=1e-6)
+
+    rgb = compositor.render(imc_img, ['a', 'b', 'c'], plots.RGB_COLORS, caps=caps)
+    np.testing.assert_allclose(rgb[..., 1], np.minimum(imc_img.imgs['b'] / caps[1], 1), rtol=1e-6)
+    # channels without a cap use the percentile
+    rgb = compositor.render(imc_img, ['a', 'b'], plots.RGB_COLORS, caps=[caps[0], None])
+    np.testing.assert_allclose(rgb[..., 1], compositor.get_channel(imc_img, 'b'))
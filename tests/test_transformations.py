@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+from pycytools import transformations as transf
+
+
+def make_table():
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(rng.random((1000, 4)) * 100, columns=['c0', 'c1', 'c2', 'c3'])
+
+
+def test_asinhtransf_table():
+    dat = make_table()
+    exp = transf.asinhtransf_data(dat.values, cof=5)
+    out = transf.asinhtransf_table(dat, cofactors=5, chunk_size=300)
+    assert (out.dtypes == np.float32).all()
+    pd.testing.assert_index_equal(out.columns, dat.columns)
+    np.testing.assert_allclose(out.values, exp, rtol=1e-6)
+    inv = transf.inv_asinhtransf_table(out, cofactors=5, dtype=np.float64, chunk_size=300)
+    np.testing.assert_allclose(inv.values, dat.values, rtol=1e-4)
+
+
+def test_transf_table_inplace():
+    dat = make_table()
+    exp = transf.logtransf_data(dat.values, offset=1)
+    view = dat[['c0']]
+    out = transf.logtransf_table(dat, offsets=1, inplace=True, chunk_size=300)
+    assert out is dat
+    np.testing.assert_allclose(dat.values, exp)
+    # frames sharing the data are not modified
+    np.testing.assert_allclose(view.values, make_table()[['c0']].values)
+
+    mixed = pd.DataFrame({'a': np.arange(10, dtype=np.float64), 'b': np.arange(10)})
+    transf.logtransf_table(mixed, offsets=1, inplace=True)
+    np.testing.assert_allclose(mixed.values, np.log10(np.arange(10)[:, np.newaxis] + 1) * np.ones(2), rtol=1e-6)